@@ -0,0 +1,22 @@
+"""Helpers shared by the benchmarks, which compare a previous and a current path."""
+
+import time
+from typing import Callable
+
+
+def bench(fn: Callable, *args, repeat: int) -> float:
+    """The best time of `repeat` calls of `fn(*args)`, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(case: str, previous: float, current: float) -> None:
+    """Print the times of both paths for `case` and the speedup of the current one."""
+    print(
+        f"{case}: previous {previous * 1e3:8.2f} ms, "
+        f"current {current * 1e3:8.2f} ms ({previous / current:.1f}x)"
+    )
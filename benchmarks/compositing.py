@@ -0,0 +1,49 @@
+"""
+Compare pasting a hat with `composite` against the previous float64 per-channel blend.
+
+    python -m benchmarks.compositing --size 400
+"""
+
+import argparse
+
+import numpy as np
+
+from benchmarks import bench, report
+from src.xmas_hat.wear_hat import composite
+
+
+def previous_path(roi: np.ndarray, hat: np.ndarray) -> None:
+    alpha_h = hat[..., 3] / 255
+    alpha = 1 - alpha_h
+    for channel in range(3):
+        roi[..., channel] = alpha_h * hat[..., channel] + alpha * roi[..., channel]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, nargs="+", default=[100, 400, 1600])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for size in args.size:
+        roi = rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8)
+        hat = rng.integers(0, 256, size=(size, size, 4), dtype=np.uint8)
+        binary_hat = hat.copy()
+        binary_hat[..., 3] = np.where(hat[..., 3] > 127, 255, 0)
+
+        for name, h, binary in [("general", hat, False), ("binary", binary_hat, True)]:
+            expected, res = roi.copy(), roi.copy()
+            previous_path(expected, h)
+            composite(res, h, binary)
+            # the previous path truncates where OpenCV rounds
+            assert np.abs(res.astype(np.int16) - expected).max() <= 1
+
+            # both paths blend in place, and take as long on an already blended roi
+            prev = bench(previous_path, roi.copy(), h, repeat=args.repeat)
+            curr = bench(composite, roi.copy(), h, binary, repeat=args.repeat)
+            report(f"{size:5d}px {name:>7s} alpha", prev, curr)
+
+
+if __name__ == "__main__":
+    main()
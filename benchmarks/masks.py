@@ -0,0 +1,65 @@
+"""
+Compare building the box mask of a detection result with `mask_from_boxes` against the
+previous path (one full-size mask per box, reduced with `np.logical_or`).
+
+    python -m benchmarks.masks --height 3000 --width 4000 --num-boxes 100
+"""
+
+import argparse
+import functools as ft
+
+import numpy as np
+
+from benchmarks import bench, report
+from src.yolo_world.utils import apply_mask, mask_from_boxes
+
+
+def mask_from_box_coordinates(coordinates: np.ndarray, img: np.ndarray) -> np.ndarray:
+    ul_br_coords = np.round(coordinates).astype(np.int32)
+    ul, br = np.split(ul_br_coords, 2)
+    width = br[0] - ul[0]
+    height = br[1] - ul[1]
+    mask = np.zeros_like(img)
+    mask[ul[1] :, ul[0] :][:height, :width] = 1
+
+    return mask
+
+
+def previous_path(img: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    masks = [mask_from_box_coordinates(box, img) for box in boxes]
+    mask = ft.reduce(np.logical_or, masks, np.zeros_like(masks[0]))
+    return img * mask
+
+
+def current_path(img: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    return apply_mask(img, mask_from_boxes(boxes, img.shape))
+
+
+def random_boxes(rng: np.random.Generator, num: int, height: int, width: int):
+    xs = np.sort(rng.uniform(0, width, size=(num, 2)), axis=1)
+    ys = np.sort(rng.uniform(0, height, size=(num, 2)), axis=1)
+    return np.stack([xs[:, 0], ys[:, 0], xs[:, 1], ys[:, 1]], axis=1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--num-boxes", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=(args.height, args.width, 3), dtype=np.uint8)
+
+    for num in args.num_boxes:
+        boxes = random_boxes(rng, num, args.height, args.width)
+        assert np.array_equal(previous_path(img, boxes), current_path(img, boxes))
+
+        prev = bench(previous_path, img, boxes, repeat=args.repeat)
+        curr = bench(current_path, img, boxes, repeat=args.repeat)
+        report(f"{num:4d} boxes", prev, curr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Compare filtering the raw detections of a batch with `filter_boxes` against the
+previous path (NMS over all boxes of each image, then slicing `InstanceData` for the
+score threshold and the top-k).
+
+    python -m benchmarks.postprocess --batch-size 4 --num-boxes 8400
+
+All boxes share one class, so that the class-aware NMS of `filter_boxes` keeps the
+same boxes as the class-agnostic one of the previous path.
+"""
+
+import argparse
+
+import numpy as np
+import torch
+from mmengine.structures import InstanceData
+from torchvision.ops import nms
+
+from benchmarks import bench, report
+from src.yolo_world.postprocess import filter_boxes
+
+SCORE_THRES = 0.05
+NMS_THRES = 0.5
+MAX_NUM_BOXES = 100
+
+
+def previous_filter(results: InstanceData) -> np.ndarray:
+    keep = nms(results.bboxes, results.scores, iou_threshold=NMS_THRES)
+    results = results[keep]
+    results = results[results.scores > SCORE_THRES]
+
+    if len(results.scores) > MAX_NUM_BOXES:
+        indices = results.scores.topk(MAX_NUM_BOXES)[1]
+        results = results[indices]
+
+    return results.cpu().numpy().bboxes
+
+
+def previous_path(batch: list[InstanceData]) -> list[np.ndarray]:
+    return [previous_filter(results) for results in batch]
+
+
+def current_path(batch: list[InstanceData]) -> list[np.ndarray]:
+    return filter_boxes(batch, SCORE_THRES, NMS_THRES, MAX_NUM_BOXES)
+
+
+def random_results(generator: torch.Generator, num: int) -> InstanceData:
+    # scores skewed towards 0, like those of a detector over its anchor points
+    corners = torch.rand(num, 2, generator=generator) * 600
+    sizes = torch.rand(num, 2, generator=generator) * 100 + 5
+    return InstanceData(
+        bboxes=torch.cat([corners, corners + sizes], dim=1),
+        scores=torch.rand(num, generator=generator) ** 4,
+        labels=torch.zeros(num, dtype=torch.long),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 4, 16])
+    # anchor points of a 640x640 input at strides 8, 16 and 32
+    parser.add_argument("--num-boxes", type=int, default=8400)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    for batch_size in args.batch_size:
+        batch = [random_results(generator, args.num_boxes) for _ in range(batch_size)]
+        for prev_boxes, curr_boxes in zip(previous_path(batch), current_path(batch)):
+            assert np.array_equal(prev_boxes, curr_boxes)
+
+        prev = bench(previous_path, batch, repeat=args.repeat)
+        curr = bench(current_path, batch, repeat=args.repeat)
+        report(f"batch of {batch_size:2d}", prev, curr)
+
+
+if __name__ == "__main__":
+    main()
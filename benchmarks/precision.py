@@ -0,0 +1,81 @@
+"""
+Compare the accuracy and latency of the inference precisions against fp32.
+
+    python -m benchmarks.precision "assets/demo/*.jpg" --labels person
+
+Boxes of every precision are matched to the fp32 ones of the same image. "recall" is
+the fraction of fp32 boxes with a match of IoU >= 0.5 and "IoU" the mean IoU of the
+matches. Latency covers decoding, preprocessing and inference of one image.
+"""
+
+import argparse
+import gc
+import glob
+from pathlib import Path
+
+import numpy as np
+import torch
+from torchvision.ops import box_iou
+
+from benchmarks import bench
+from src.yolo_world.init import PRECISIONS
+from src.yolo_world.server import Server
+
+
+def agreement(boxes: np.ndarray, reference: np.ndarray) -> tuple[int, list[float]]:
+    """Greedily match `boxes` to `reference`, return the count and IoUs of matches."""
+    if len(boxes) == 0 or len(reference) == 0:
+        return 0, []
+
+    ious = box_iou(torch.from_numpy(reference), torch.from_numpy(boxes)).numpy()
+    matched = []
+    while ious.size > 0 and ious.max() >= 0.5:
+        i, j = np.unravel_index(ious.argmax(), ious.shape)
+        matched.append(float(ious[i, j]))
+        ious[i, :] = 0
+        ious[:, j] = 0
+    return len(matched), matched
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", help="glob pattern of the fixed image set")
+    parser.add_argument("--labels", default="person")
+    parser.add_argument("--precision", nargs="+", default=list(PRECISIONS))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    paths = [Path(p) for p in sorted(glob.glob(args.images, recursive=True))]
+    labels = args.labels.split(",")
+    precisions = ["fp32"] + [p for p in args.precision if p != "fp32"]
+
+    reference: list[np.ndarray] = []
+    for precision in precisions:
+        server = Server(precision=precision, warm_up_batch_sizes=(1,))
+        latencies, results = [], []
+        for path in paths:
+            results.append(server.detect(path, labels))
+            latencies.append(bench(server.detect, path, labels, repeat=args.repeat))
+        if precision == "fp32":
+            reference = results
+
+        num_matched, ious = 0, []
+        for boxes, expected in zip(results, reference):
+            n, matched = agreement(boxes, expected)
+            num_matched += n
+            ious += matched
+        num_expected = sum(len(expected) for expected in reference)
+        print(
+            f"{precision:>5s}: median {np.median(latencies) * 1e3:8.1f} ms/image, "
+            f"recall {num_matched / max(num_expected, 1):.3f}, "
+            f"IoU {np.mean(ious) if ious else float('nan'):.3f}"
+        )
+
+        server.close()
+        # free the weights before loading the next precision
+        del server
+        gc.collect()
+
+
+if __name__ == "__main__":
+    main()
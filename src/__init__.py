@@ -1 +0,0 @@
-from .yolo_world.server import Server
@@ -1,15 +1,109 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any
 
-from src.utils.json import from_optional, from_path, from_str
+from src.utils.json import (
+    from_bool,
+    from_float,
+    from_int,
+    from_list,
+    from_optional,
+    from_path,
+    from_str,
+)
+
+ARTIFACTS = ("result", "masked", "masked-with-hats", "preview")
+FORMATS = ("jpeg", "png", "webp")
+
+
+@dataclass
+class OutputOptions:
+    """
+    Which images the server writes for a request and how they are encoded.
+
+    `artifacts` is a subset of `ARTIFACTS`. `format` is one of `FORMATS`, or `None` to
+    follow the suffix of the target path. `quality` applies to JPEG and WebP.
+    `preview_size` is the longer side of the "preview" artifact.
+    """
+
+    artifacts: list[str] = field(default_factory=lambda: ["result"])
+    format: str | None = None
+    quality: int | None = None
+    preview_size: int = 512
+
+    @staticmethod
+    def from_dict(obj: Any) -> "OutputOptions":
+        assert isinstance(obj, dict)
+
+        artifacts = from_optional(
+            lambda x: from_list(from_str, x), obj.get("artifacts")
+        )
+        assert artifacts is None or set(artifacts) <= set(ARTIFACTS)
+        fmt = from_optional(from_str, obj.get("format"))
+        assert fmt is None or fmt in FORMATS
+        quality = from_optional(from_int, obj.get("quality"))
+        preview_size = from_optional(from_int, obj.get("preview_size"))
+
+        res = OutputOptions(format=fmt, quality=quality)
+        if artifacts is not None and len(artifacts) > 0:
+            res.artifacts = artifacts
+        if preview_size is not None:
+            res.preview_size = preview_size
+        return res
+
+    def to_dict(self) -> dict:
+        res: dict[str, Any] = dict(
+            artifacts=self.artifacts, preview_size=self.preview_size
+        )
+        if self.format is not None:
+            res["format"] = self.format
+        if self.quality is not None:
+            res["quality"] = self.quality
+        return res
+
+
+@dataclass
+class SharedImage:
+    """An (H, W, 3) uint8 RGB image in the shared memory segment named `name`."""
+
+    name: str
+    shape: tuple[int, int, int]
+
+    @staticmethod
+    def from_dict(obj: Any) -> "SharedImage":
+        assert isinstance(obj, dict)
+
+        name = from_str(obj.get("name"))
+        shape = tuple(from_list(from_int, obj.get("shape")))
+        assert len(shape) == 3 and shape[2] == 3 and min(shape) > 0
+
+        return SharedImage(name, shape)
+
+    def to_dict(self) -> dict:
+        return dict(name=self.name, shape=list(self.shape))
 
 
 @dataclass
 class YoloMessage:
+    """
+    Request to process `img_path`.
+
+    If `img_shm` is set, the pixels are read from it instead of `img_path`, which then
+    only names the outputs. If `res_shm` is set, the result is written into it instead
+    of a file. If `progress` is set, the server also sends a "progress" response when
+    the request enters each stage. `latency_budget` in seconds lets the server run a
+    smaller model if the default one is expected to take longer.
+    """
+
     img_path: Path
     labels: list[str]
     tgt_path: Path | None = None
+    request_id: str | None = None
+    output: OutputOptions = field(default_factory=OutputOptions)
+    img_shm: SharedImage | None = None
+    res_shm: SharedImage | None = None
+    progress: bool = False
+    latency_budget: float | None = None
 
     @staticmethod
     def from_dict(obj: Any) -> "YoloMessage":
@@ -18,11 +112,115 @@ class YoloMessage:
         img_path = from_path(obj.get("img_path"))
         labels = list(map(lambda x: x.strip(), from_str(obj.get("labels")).split(",")))
         tgt_path = from_optional(from_path, obj.get("tgt_path"))
+        request_id = from_optional(from_str, obj.get("request_id"))
+        output = from_optional(OutputOptions.from_dict, obj.get("output"))
+        img_shm = from_optional(SharedImage.from_dict, obj.get("img_shm"))
+        res_shm = from_optional(SharedImage.from_dict, obj.get("res_shm"))
+        progress = from_optional(from_bool, obj.get("progress"))
+        latency_budget = from_optional(from_float, obj.get("latency_budget"))
+
+        return YoloMessage(
+            img_path,
+            labels,
+            tgt_path,
+            request_id,
+            output or OutputOptions(),
+            img_shm,
+            res_shm,
+            progress or False,
+            latency_budget,
+        )
+
+    def to_dict(self) -> dict:
+        res: dict[str, Any] = dict(
+            img_path=f"{self.img_path}", labels=",".join(self.labels)
+        )
+        if self.tgt_path is not None:
+            res["tgt_path"] = f"{self.tgt_path}"
+        if self.request_id is not None:
+            res["request_id"] = self.request_id
+        res["output"] = self.output.to_dict()
+        if self.img_shm is not None:
+            res["img_shm"] = self.img_shm.to_dict()
+        if self.res_shm is not None:
+            res["res_shm"] = self.res_shm.to_dict()
+        if self.progress:
+            res["progress"] = self.progress
+        if self.latency_budget is not None:
+            res["latency_budget"] = self.latency_budget
+        return res
+
+
+@dataclass
+class CancelMessage:
+    """Ask the server to drop the request `request_id` of the same connection."""
+
+    request_id: str
+
+    @staticmethod
+    def is_cancel(obj: Any) -> bool:
+        return isinstance(obj, dict) and obj.get("type") == "cancel"
+
+    @staticmethod
+    def from_dict(obj: Any) -> "CancelMessage":
+        assert CancelMessage.is_cancel(obj)
+
+        request_id = from_str(obj.get("request_id"))
+
+        return CancelMessage(request_id)
+
+    def to_dict(self) -> dict:
+        return dict(type="cancel", request_id=self.request_id)
+
+
+@dataclass
+class YoloResponse:
+    """
+    Reply to a `YoloMessage`.
+
+    `status` is one of "ok", "error", "busy", "progress" and "cancelled". A "busy"
+    response means the request was rejected because the server queue is full, and may
+    be resent after `retry_after` seconds. A "progress" response names the `stage` the
+    request has entered and is followed by another response. `res_shm` is set if the
+    result was written into the segment of the request rather than to `tgt_path`.
+    """
+
+    status: str
+    tgt_path: Path | None = None
+    error: str | None = None
+    request_id: str | None = None
+    retry_after: float | None = None
+    res_shm: SharedImage | None = None
+    stage: str | None = None
+
+    @staticmethod
+    def from_dict(obj: Any) -> "YoloResponse":
+        assert isinstance(obj, dict)
+
+        status = from_str(obj.get("status"))
+        tgt_path = from_optional(from_path, obj.get("tgt_path"))
+        error = from_optional(from_str, obj.get("error"))
+        request_id = from_optional(from_str, obj.get("request_id"))
+        retry_after = from_optional(from_float, obj.get("retry_after"))
+        res_shm = from_optional(SharedImage.from_dict, obj.get("res_shm"))
+        stage = from_optional(from_str, obj.get("stage"))
 
-        return YoloMessage(img_path, labels, tgt_path)
+        return YoloResponse(
+            status, tgt_path, error, request_id, retry_after, res_shm, stage
+        )
 
     def to_dict(self) -> dict:
-        res = dict(img_path=f"{self.img_path}", labels=",".join(self.labels))
+        res: dict[str, Any] = dict(status=self.status)
         if self.tgt_path is not None:
             res["tgt_path"] = f"{self.tgt_path}"
+        if self.error is not None:
+            res["error"] = self.error
+        if self.request_id is not None:
+            res["request_id"] = self.request_id
+        if self.retry_after is not None:
+            res["retry_after"] = self.retry_after
+        if self.res_shm is not None:
+            res["res_shm"] = self.res_shm.to_dict()
+        if self.stage is not None:
+            res["stage"] = self.stage
         return res
@@ -0,0 +1,47 @@
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from src.communication.messages import SharedImage
+
+
+def create_image(
+    shape: tuple[int, int, int],
+) -> tuple[SharedMemory, SharedImage, np.ndarray]:
+    """
+    Allocate a segment for an image of `shape` and return it with its reference and a
+    writable view. The creator is responsible for unlinking it.
+    """
+    segment = SharedMemory(create=True, size=int(np.prod(shape)))
+    img = np.ndarray(shape, np.uint8, buffer=segment.buf)
+    return segment, SharedImage(segment.name, shape), img
+
+
+def attach_image(
+    ref: SharedImage, writable: bool = False
+) -> tuple[SharedMemory, np.ndarray]:
+    """
+    Map the segment of `ref` and return it with a view of the image, without copying.
+
+    The view must be dropped before the segment is closed.
+    """
+    segment = _open(ref.name)
+    if segment.size < int(np.prod(ref.shape)):
+        segment.close()
+        raise ValueError(f"Segment {ref.name} is too small for {ref.shape}.")
+
+    img = np.ndarray(ref.shape, np.uint8, buffer=segment.buf)
+    img.flags.writeable = writable
+    return segment, img
+
+
+def _open(name: str) -> SharedMemory:
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, track=False)
+
+    segment = SharedMemory(name)
+    # attaching registers the segment too, and the tracker would unlink it at exit
+    resource_tracker.unregister(segment._name, "shared_memory")  # type: ignore
+    return segment
@@ -0,0 +1,73 @@
+import json
+import socket
+import struct
+import time
+from pathlib import Path
+from typing import Any
+
+# Every frame is a 4-byte big-endian payload length followed by a UTF-8 JSON payload.
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def create_server(sock_path: Path, backlog: int = 16) -> socket.socket:
+    """Bind a listening Unix domain socket at `sock_path`, replacing a stale one."""
+    if sock_path.exists():
+        sock_path.unlink()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(f"{sock_path}")
+    sock.listen(backlog)
+    return sock
+
+
+def connect(sock_path: Path) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(f"{sock_path}")
+    return sock
+
+
+def send_msg(sock: socket.socket, obj: dict) -> None:
+    payload = json.dumps(obj).encode()
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_msg(sock: socket.socket, timings: dict[str, float] | None = None) -> Any:
+    """
+    Block until a whole frame arrives and return the decoded JSON object.
+
+    Return `None` if the peer closed the connection cleanly between two frames. If
+    `timings` is given, the seconds from the arrival of the header to the decoded object
+    are stored under "receive", which excludes waiting for the peer to send.
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    start = time.perf_counter()
+
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Frame of {size} bytes exceeds {MAX_FRAME_SIZE}.")
+
+    payload = _recv_exactly(sock, size)
+    if payload is None:
+        raise ConnectionError("Connection closed in the middle of a frame.")
+    obj = json.loads(payload)
+    if timings is not None:
+        timings["receive"] = time.perf_counter() - start
+    return obj
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes | None:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            if received == 0:
+                return None
+            raise ConnectionError("Connection closed in the middle of a frame.")
+        received += n
+
+    return bytes(buf)
@@ -1,7 +1,8 @@
-import json
+import argparse
 import os
+import socket
 import sys
-import time
+import uuid
 from pathlib import Path
 
 import cv2
@@ -11,19 +12,37 @@ os.environ["QT_QPA_PLATFORM_PLUGIN_PATH"] = QLibraryInfo.location(
     QLibraryInfo.PluginsPath
 )
 
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtWidgets import (QApplication, QFileDialog, QFrame, QHBoxLayout,
-                             QLabel, QLineEdit, QPushButton, QVBoxLayout,
-                             QWidget)
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QImage, QImageReader, QPixmap
+from PyQt5.QtWidgets import (QApplication, QComboBox, QFileDialog, QFrame,
+                             QHBoxLayout, QLabel, QLineEdit, QPushButton,
+                             QVBoxLayout, QWidget)
+
+from src.communication.messages import YoloMessage, YoloResponse
+from src.gui.history import HistoryEntry, ResultHistory
+from src.gui.worker import RequestWorker
+
+REQUEST_TIMEOUT = 60.0
+# smooth rescaling waits until the window has not been resized for this long
+RESCALE_DELAY_MS = 150
 
 
 class App(QWidget):
-    def __init__(self, msg_file: Path):
+    def __init__(
+        self,
+        sock_file: Path,
+        use_shm: bool = False,
+        timeout: float = REQUEST_TIMEOUT,
+    ):
         super().__init__()
         self._init_ui()
 
-        self.msg_file = msg_file
+        self.sock_file = sock_file
+        # pass pixels through shared memory instead of files, both ends on one host
+        self.use_shm = use_shm
+        self.timeout = timeout
+        self._conn: socket.socket | None = None
+        self._worker: RequestWorker | None = None
 
     def _init_ui(self):
         self.setWindowTitle("A Fun App")
@@ -39,9 +58,19 @@ class App(QWidget):
         )  # Ensure width is consistent
         self.submit_button.clicked.connect(self.process_image)
 
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setFixedWidth(self.upload_button.sizeHint().width())
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_request)
+
         self.text_input = QLineEdit()
         self.text_input.setPlaceholderText("Enter labels to detect...")
 
+        self.history_box = QComboBox()
+        self.history_box.setPlaceholderText("Past results")
+        self.history_box.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+        self.history_box.activated.connect(self.show_history)
+
         # Frames for displaying images with square size
         self.original_frame = QFrame()
         self.original_frame.setFrameShape(QFrame.Box)
@@ -59,7 +88,9 @@ class App(QWidget):
         top_layout = QHBoxLayout()
         top_layout.addWidget(self.upload_button)
         top_layout.addWidget(self.submit_button)
+        top_layout.addWidget(self.cancel_button)
         top_layout.addWidget(self.text_input)
+        top_layout.addWidget(self.history_box)
 
         # image frames
         image_layout = QHBoxLayout()
@@ -81,39 +112,51 @@ class App(QWidget):
         # Variables
         self.orig_img_path = None
         self.res_path = None
+        # full-size images, decoded once and only rescaled afterwards
+        self.orig_image: QImage | None = None
+        self.orig_full_pixmap: QPixmap | None = None
+        self.res_full_pixmap: QPixmap | None = None
+        self.history = ResultHistory()
+        self._submitted: tuple[str, str, QImage, QPixmap] | None = None
+
+        self._rescale_timer = QTimer(self)
+        self._rescale_timer.setSingleShot(True)
+        self._rescale_timer.setInterval(RESCALE_DELAY_MS)
+        self._rescale_timer.timeout.connect(self._show_images)
 
     def upload_image(self):
         file_path, _ = QFileDialog.getOpenFileName(
             self, "Open Image File", "", "Images (*.png *.jpg *.jpeg *.bmp)"
         )
         if file_path:
+            reader = QImageReader(file_path)
+            # match the EXIF handling of the server
+            reader.setAutoTransform(True)
             self.orig_img_path = file_path
-            self.orig_img_pixmap = QPixmap(file_path).scaled(
-                self.original_image_label.size(),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation,
-            )
-            self.original_image_label.setPixmap(self.orig_img_pixmap)
+            self.orig_image = reader.read().convertToFormat(QImage.Format_RGB888)
+            self.orig_full_pixmap = QPixmap.fromImage(self.orig_image)
+            self._show_image(self.orig_full_pixmap, self.original_image_label)
 
     def resizeEvent(self, event):
-        if self.orig_img_path:
-            self.orig_img_pixmap = QPixmap(self.orig_img_path).scaled(
-                self.original_image_label.size(),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation,
-            )
-            self.original_image_label.setPixmap(self.orig_img_pixmap)
-
-        if self.res_path:
-            self.res_img_pixmap = QPixmap(self.res_path).scaled(
-                self.processed_image_label.size(),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation,
-            )
-            self.processed_image_label.setPixmap(self.res_img_pixmap)
+        # cheap nearest-neighbour scaling while resizing, smooth once it settles
+        self._show_images(Qt.FastTransformation)
+        self._rescale_timer.start()
 
         super().resizeEvent(event)
 
+    def _show_images(self, mode: Qt.TransformationMode = Qt.SmoothTransformation):
+        self._show_image(self.orig_full_pixmap, self.original_image_label, mode)
+        self._show_image(self.res_full_pixmap, self.processed_image_label, mode)
+
+    @staticmethod
+    def _show_image(
+        pixmap: QPixmap | None,
+        label: QLabel,
+        mode: Qt.TransformationMode = Qt.SmoothTransformation,
+    ):
+        if pixmap is not None:
+            label.setPixmap(pixmap.scaled(label.size(), Qt.KeepAspectRatio, mode))
+
     def process_image(self):
         if not self.orig_img_path:
             self.original_image_label.setText("Please upload an image first!")
@@ -123,36 +166,108 @@ class App(QWidget):
         user_text = self.text_input.text()
 
         ############ Call the function to process the image and pass user text  ################
+        # the response arrives in `_on_response` without blocking the event loop
         self.communicate_with_yolo_world(self.orig_img_path, user_text)
 
-        if self.res_path is not None:
-            self.res_img_pixmap = QPixmap(self.res_path).scaled(
-                self.processed_image_label.size(),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation,
-            )
-            self.processed_image_label.setPixmap(self.res_img_pixmap)
+    def cancel_request(self):
+        if self._worker is not None:
+            self._worker.cancel()
 
     def communicate_with_yolo_world(self, img_path: str, labels: str) -> None:
         path_to_orig = Path(img_path).resolve()
         path_to_res = path_to_orig.with_suffix(f".res{path_to_orig.suffix}")
 
-        if not path_to_res.exists():
-            path_to_res.touch()
-        timestamp = path_to_res.stat().st_mtime_ns
+        msg = YoloMessage(
+            path_to_orig,
+            [label.strip() for label in labels.split(",")],
+            path_to_res,
+            uuid.uuid4().hex,
+        )
+        assert self.orig_image is not None and self.orig_full_pixmap is not None
+        self._submitted = (
+            f"{path_to_orig.name}: {','.join(msg.labels)}",
+            img_path,
+            self.orig_image,
+            self.orig_full_pixmap,
+        )
 
-        msg = {
-            "img_path": f"{path_to_orig}",
-            "labels": labels,
-            "tgt_path": f"{path_to_res}",
-        }
-        with open(self.msg_file, "w") as fd:
-            json.dump(msg, fd)
+        # the worker owns the connection until it finishes
+        self._worker = RequestWorker(
+            self.sock_file,
+            self._conn,
+            msg,
+            self.orig_image if self.use_shm else None,
+            self.timeout,
+        )
+        self._conn = None
+        self._worker.progress.connect(self.processed_image_label.setText)
+        self._worker.succeeded.connect(self._on_response)
+        self._worker.failed.connect(self.processed_image_label.setText)
+        self._worker.finished.connect(self._on_worker_finished)
+
+        self.submit_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self._worker.start()
+
+    def _on_response(self, response: YoloResponse, res_image: QImage | None):
+        if response.status == "cancelled":
+            self.processed_image_label.setText("Cancelled.")
+            return
+        if response.status != "ok":
+            self.processed_image_label.setText(f"Server error: {response.error}")
+            return
+
+        if res_image is not None:
+            self.res_path = None
+            self.res_full_pixmap = QPixmap.fromImage(res_image)
+        elif response.tgt_path is not None:
+            self.res_path = f"{response.tgt_path}"
+            self.res_full_pixmap = QPixmap(self.res_path)
+        else:
+            return
+        self._show_image(self.res_full_pixmap, self.processed_image_label)
 
-        while path_to_res.stat().st_mtime_ns == timestamp:
-            time.sleep(0.1)
+        assert self._submitted is not None and response.request_id is not None
+        self.history.put(
+            response.request_id,
+            HistoryEntry(*self._submitted, self.res_full_pixmap, self.res_path),
+        )
+        self._update_history_box(response.request_id)
+
+    def show_history(self, index: int):
+        entry = self.history.get(self.history_box.itemData(index))
+        if entry is None:
+            return
 
-        self.res_path = f"{path_to_res}"
+        self.orig_img_path = entry.orig_img_path
+        self.orig_image = entry.orig_image
+        self.orig_full_pixmap = entry.orig_pixmap
+        self.res_full_pixmap = entry.res_pixmap
+        self.res_path = entry.res_path
+        self._show_images()
+
+    def _update_history_box(self, current: str):
+        """List the results still in the history, most recent first."""
+        self.history_box.clear()
+        for key, entry in reversed(self.history.items()):
+            self.history_box.addItem(entry.title, key)
+        self.history_box.setCurrentIndex(self.history_box.findData(current))
+
+    def _on_worker_finished(self):
+        assert self._worker is not None
+        # `finished` is emitted before `run` fully returns, and dropping the last
+        # reference to a running QThread aborts the process
+        self._worker.wait()
+        self._conn = self._worker.conn
+        self._worker = None
+        self.submit_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+
+    def closeEvent(self, event):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker.wait()
+        super().closeEvent(event)
 
     def convert_to_black_and_white(self, image_path, user_text):
         # Process the image using OpenCV
@@ -165,7 +280,22 @@ class App(QWidget):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m src.gui.app")
+    parser.add_argument("sock_file", type=Path)
+    parser.add_argument(
+        "--shm",
+        action="store_true",
+        help="exchange pixels with the server through shared memory",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=REQUEST_TIMEOUT,
+        help="seconds to wait for the result of a request",
+    )
+    args = parser.parse_args()
+
     app = QApplication(sys.argv)
-    window = App(Path(sys.argv[1]).resolve())
+    window = App(args.sock_file.resolve(), args.shm, args.timeout)
     window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from PyQt5.QtGui import QImage, QPixmap
+
+
+@dataclass
+class HistoryEntry:
+    """A finished request with its full-size images, ready to be shown again."""
+
+    title: str
+    orig_img_path: str
+    orig_image: QImage
+    orig_pixmap: QPixmap
+    res_pixmap: QPixmap
+    res_path: str | None = None
+
+    @property
+    def num_bytes(self) -> int:
+        pixmaps = (self.orig_pixmap, self.res_pixmap)
+        return self.orig_image.sizeInBytes() + sum(
+            pixmap.width() * pixmap.height() * pixmap.depth() // 8 for pixmap in pixmaps
+        )
+
+
+class ResultHistory:
+    """Recently shown results, most recent last, in an LRU bounded by `max_bytes`."""
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+
+        self._entries: OrderedDict[str, HistoryEntry] = OrderedDict()
+        self._num_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def items(self) -> list[tuple[str, HistoryEntry]]:
+        """All entries, least recently used first, without touching their order."""
+        return list(self._entries.items())
+
+    def get(self, key: str) -> HistoryEntry | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: HistoryEntry) -> None:
+        if key in self._entries:
+            self._num_bytes -= self._entries.pop(key).num_bytes
+        self._entries[key] = entry
+        self._num_bytes += entry.num_bytes
+
+        while self._num_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= evicted.num_bytes
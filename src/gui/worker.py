@@ -0,0 +1,165 @@
+import socket
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from src.communication.messages import CancelMessage, YoloMessage, YoloResponse
+from src.communication.shm import create_image
+from src.communication.transport import connect, recv_msg, send_msg
+
+MAX_RETRIES = 3
+
+
+class RequestWorker(QThread):
+    """
+    Send one request to the server and wait for its response off the GUI thread.
+
+    `progress` carries a human-readable status, `succeeded` the final response together
+    with the result image if it came back through shared memory, and `failed` the
+    reason the request did not complete, including cancellation and timeout.
+    """
+
+    progress = pyqtSignal(str)
+    succeeded = pyqtSignal(object, object)
+    failed = pyqtSignal(str)
+
+    def __init__(
+        self,
+        sock_file: Path,
+        conn: socket.socket | None,
+        msg: YoloMessage,
+        image: QImage | None = None,
+        timeout: float = 60.0,
+    ) -> None:
+        super().__init__()
+        self.sock_file = sock_file
+        # handed back to the app after the run, `None` if it had to be closed
+        self.conn = conn
+        self.msg = msg
+        self.image = image
+        self.timeout = timeout
+
+        self._deadline = 0.0
+        self._cancelled = threading.Event()
+        self._send_lock = threading.Lock()
+
+    def cancel(self) -> None:
+        """Ask the server to drop the request. Safe to call from the GUI thread."""
+        self.progress.emit("Cancelling...")
+        self._send_cancel()
+
+    def _send_cancel(self) -> None:
+        self._cancelled.set()
+        conn = self.conn
+        if conn is None or self.msg.request_id is None:
+            return
+        try:
+            with self._send_lock:
+                send_msg(conn, CancelMessage(self.msg.request_id).to_dict())
+        except OSError:
+            # the worker notices the broken connection by itself
+            pass
+
+    def run(self) -> None:
+        self._deadline = time.monotonic() + self.timeout
+        self.msg.progress = True
+        try:
+            if self.conn is None:
+                self.conn = connect(self.sock_file)
+            if self.image is None:
+                self.succeeded.emit(self._request_with_retries(), None)
+            else:
+                self._request_shared(self.image)
+        except TimeoutError:
+            self._send_cancel()
+            self._close()
+            self.failed.emit(f"No response within {self.timeout:.0f}s.")
+        except OSError as e:
+            self._close()
+            self.failed.emit(f"Failed to reach the server: {e}")
+        except (ValueError, AssertionError) as e:
+            # the stream cannot be trusted after a bad frame, so reconnect next time
+            self._close()
+            self.failed.emit(f"Malformed response from the server: {e}")
+
+    def _request_shared(self, image: QImage) -> None:
+        """
+        Send the pixels of `image` in a shared memory segment and receive the result in
+        another one, so that neither side encodes or decodes an image file.
+        """
+        shape = (image.height(), image.width(), 3)
+        img_segment, self.msg.img_shm, img = create_image(shape)
+        res_segment, self.msg.res_shm, res_img = create_image(shape)
+        try:
+            img[...] = _qimage_to_array(image)
+            response = self._request_with_retries()
+            res_image = None
+            if response.status == "ok" and response.res_shm is not None:
+                # copy out of the segment, which is unlinked right after
+                res_image = QImage(
+                    res_img.data, shape[1], shape[0], 3 * shape[1], QImage.Format_RGB888
+                ).copy()
+            self.succeeded.emit(response, res_image)
+        finally:
+            del img, res_img
+            for segment in (img_segment, res_segment):
+                segment.close()
+                segment.unlink()
+
+    def _request_with_retries(self) -> YoloResponse:
+        response = self._request()
+        for _ in range(MAX_RETRIES):
+            if response.status != "busy":
+                break
+            self.progress.emit("Server is busy, retrying...")
+            if self._cancelled.wait(response.retry_after or 1.0):
+                break
+            response = self._request()
+        return response
+
+    def _request(self) -> YoloResponse:
+        assert self.conn is not None
+        if self._cancelled.is_set():
+            return YoloResponse("cancelled", request_id=self.msg.request_id)
+
+        with self._send_lock:
+            send_msg(self.conn, self.msg.to_dict())
+        self.progress.emit("Waiting for the server...")
+        while True:
+            remaining = self._deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError
+            self.conn.settimeout(remaining)
+            try:
+                # raises `TimeoutError` once the deadline passes
+                obj = recv_msg(self.conn)
+            finally:
+                self.conn.settimeout(None)
+            if obj is None:
+                raise ConnectionError("Server closed the connection.")
+
+            response = YoloResponse.from_dict(obj)
+            # skip stale responses of requests given up earlier
+            if response.request_id not in (None, self.msg.request_id):
+                continue
+            if response.status == "progress":
+                self.progress.emit(f"Running {response.stage}...")
+                continue
+            return response
+
+    def _close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _qimage_to_array(image: QImage) -> np.ndarray:
+    """View an RGB888 `image` as an (H, W, 3) array, skipping the padding of rows."""
+    ptr = image.constBits()
+    ptr.setsize(image.sizeInBytes())
+    rows = np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, : 3 * image.width()].reshape(image.height(), image.width(), 3)
@@ -1,13 +1,242 @@
-from pathlib import Path
+import functools as ft
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 import cv2
 import numpy as np
 
+from .utils import CFG_DIR, MODE_TO_PATH
+
+
+@dataclass(frozen=True)
+class DetectionPreset:
+    """
+    Speed/quality trade-off of `detect_face`.
+
+    Images are downscaled so that their longer side is at most `max_side` pixels (never
+    if `None`) before running `detectMultiScale` with `scale_factor` and
+    `min_neighbors`.
+    """
+
+    max_side: int | None
+    scale_factor: float
+    min_neighbors: int
+
+
+PRESETS = {
+    "quality": DetectionPreset(None, 1.1, 3),
+    "balanced": DetectionPreset(1280, 1.1, 3),
+    "fast": DetectionPreset(640, 1.2, 3),
+}
+
+# Detection window of the largest cascade in `MODE_TO_PATH`. Faces smaller than this at
+# the working resolution cannot be found.
+WINDOW_SIZE = 24
+
+# A face is assumed to be at least this fraction of the longer side of its object box.
+MIN_FACE_RATIO = 1 / 16
+
+_NUM_THREADS = os.cpu_count() or 1
+
+# `detectMultiScale` is not safe to call concurrently on one classifier, so each thread
+# keeps its own instance of every mode, parsed from disk only the first time.
+_local = threading.local()
+
+
+def get_cascade(mode: str) -> cv2.CascadeClassifier:
+    cascades: dict[str, cv2.CascadeClassifier] = _local.__dict__.setdefault(
+        "cascades", {}
+    )
+    if mode not in cascades:
+        config = CFG_DIR / MODE_TO_PATH[mode]
+        cascade = cv2.CascadeClassifier(f"{config}")
+        if cascade.empty():
+            raise FileNotFoundError(f"Failed to load cascade from {config}.")
+        cascades[mode] = cascade
+
+    return cascades[mode]
+
+
+def warm_up_cascades() -> None:
+    """Start every detection thread, which loads its classifiers, ahead of time."""
+    barrier = threading.Barrier(_NUM_THREADS)
+    # blocking on the barrier keeps each task on a thread of its own
+    futures = [_get_pool().submit(barrier.wait) for _ in range(_NUM_THREADS)]
+    for future in futures:
+        future.result()
+
+
+def _load_cascades() -> None:
+    for mode in MODE_TO_PATH:
+        get_cascade(mode)
+
+
+@dataclass
+class _Region:
+    """Part of an image searched for faces, equalized once and shared by all modes."""
+
+    left: int
+    top: int
+    hist: np.ndarray | None = None
+    scale: float = 1.0
+    min_size: int | None = None
+    max_size: int | None = None
+
+
+def detect_face(
+    img: np.ndarray,
+    mode: str,
+    preset: str = "balanced",
+    min_size: int | None = None,
+    max_size: int | None = None,
+) -> np.ndarray:
+    """
+    Detect (x, y, w, h) faces of at least `min_size` and at most `max_size` pixels.
+
+    Detection runs at the working resolution of `preset`, but no lower than what keeps
+    `min_size` faces detectable, and the faces are mapped back to `img` coordinates.
+    """
+    region = _Region(0, 0, min_size=min_size, max_size=max_size)
+    _prepare(region, img, preset)
+    return _detect(region, mode, preset)
+
+
+def detect_faces(
+    img: np.ndarray,
+    modes: list[str],
+    boxes: np.ndarray | None = None,
+    preset: str = "balanced",
+    margin: float = 0.1,
+    timings: dict[str, float] | None = None,
+) -> np.ndarray:
+    """
+    Detect faces of all `modes` and return them de-duplicated as (x, y, w, h) in `img`
+    coordinates.
+
+    If the (N, 4) xyxy `boxes` are given, only search inside them, each padded by
+    `margin` of its size; the size of a box also bounds the size of its faces. Every
+    region is converted to an equalized grayscale image once, then the cascades of all
+    modes and regions run in parallel.
+
+    If `timings` is given, the seconds each cascade spent over all regions are stored
+    under "cascade-<mode>".
+    """
+    height, width = img.shape[:2]
+    if boxes is None:
+        regions = [_Region(0, 0)]
+        crops = [img]
+    else:
+        regions, crops = [], []
+        for x1, y1, x2, y2 in boxes:
+            pad_x, pad_y = (x2 - x1) * margin, (y2 - y1) * margin
+            left, top = max(int(x1 - pad_x), 0), max(int(y1 - pad_y), 0)
+            right = min(int(x2 + pad_x) + 1, width)
+            bottom = min(int(y2 + pad_y) + 1, height)
+            if right <= left or bottom <= top:
+                continue
+
+            min_size = max(WINDOW_SIZE, int(max(x2 - x1, y2 - y1) * MIN_FACE_RATIO))
+            max_size = min(right - left, bottom - top)
+            regions.append(_Region(left, top, min_size=min_size, max_size=max_size))
+            crops.append(img[top:bottom, left:right])
+
+    pool = _get_pool()
+    prepared = [
+        pool.submit(_prepare, region, crop, preset)
+        for region, crop in zip(regions, crops)
+    ]
+    detections = []
+    for region, future in zip(regions, prepared):
+        future.result()
+        detections.extend(
+            (mode, pool.submit(_timed_detect, region, mode, preset)) for mode in modes
+        )
+
+    faces = []
+    for mode, future in detections:
+        region_faces, elapsed = future.result()
+        faces.append(region_faces)
+        if timings is not None:
+            key = f"cascade-{mode}"
+            timings[key] = timings.get(key, 0.0) + elapsed
+    if len(faces) == 0:
+        return np.empty((0, 4), dtype=np.int32)
+    return dedupe_faces(np.concatenate(faces))
+
+
+def _prepare(region: _Region, img: np.ndarray, preset: str) -> None:
+    config = PRESETS[preset]
+    scale = 1.0
+    if config.max_side is not None:
+        scale = min(scale, config.max_side / max(img.shape[:2]))
+    if region.min_size is not None:
+        scale = max(scale, min(1.0, WINDOW_SIZE / region.min_size))
+
+    if scale < 1.0:
+        img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-def detect_face(img: np.ndarray, config: Path) -> np.ndarray:
     grey_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    hist = cv2.equalizeHist(grey_img)
-    face_cascade = cv2.CascadeClassifier(config)
-    faces = face_cascade.detectMultiScale(hist)
+    region.hist = cv2.equalizeHist(grey_img)
+    region.scale = scale
+
+
+def _timed_detect(region: _Region, mode: str, preset: str) -> tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    faces = _detect(region, mode, preset)
+    return faces, time.perf_counter() - start
+
+
+def _detect(region: _Region, mode: str, preset: str) -> np.ndarray:
+    config = PRESETS[preset]
+    faces = get_cascade(mode).detectMultiScale(
+        region.hist,
+        scaleFactor=config.scale_factor,
+        minNeighbors=config.min_neighbors,
+        minSize=_scaled_size(region.min_size, region.scale),
+        maxSize=_scaled_size(region.max_size, region.scale),
+    )
+
+    faces = np.asarray(faces, dtype=np.float64).reshape(-1, 4) / region.scale
+    return np.round(faces).astype(np.int32) + (region.left, region.top, 0, 0)
+
+
+def _scaled_size(size: int | None, scale: float) -> tuple[int, int]:
+    # (0, 0) means no limit to OpenCV
+    if size is None:
+        return (0, 0)
+    return (round(size * scale),) * 2
+
+
+def dedupe_faces(faces: np.ndarray, iou_thres: float = 0.5) -> np.ndarray:
+    """
+    Drop faces overlapping a larger one by more than `iou_thres`, as happens when the
+    same face is found through overlapping boxes or by several cascades.
+    """
+    faces = faces[np.argsort(-faces[:, 2] * faces[:, 3], kind="stable")]
+    x1, y1 = faces[:, 0], faces[:, 1]
+    x2, y2 = x1 + faces[:, 2], y1 + faces[:, 3]
+    areas = faces[:, 2] * faces[:, 3]
+
+    keep: list[int] = []
+    for i in range(len(faces)):
+        if len(keep) > 0:
+            inter_w = np.minimum(x2[i], x2[keep]) - np.maximum(x1[i], x1[keep])
+            inter_h = np.minimum(y2[i], y2[keep]) - np.maximum(y1[i], y1[keep])
+            inter = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+            iou = inter / (areas[i] + areas[keep] - inter)
+            if iou.max() > iou_thres:
+                continue
+        keep.append(i)
+
+    return faces[keep]
+
 
-    return faces
+@ft.cache
+def _get_pool() -> ThreadPoolExecutor:
+    # OpenCV releases the GIL while detecting
+    return ThreadPoolExecutor(
+        _NUM_THREADS, thread_name_prefix="face-detection", initializer=_load_cascades
+    )
@@ -2,13 +2,31 @@ import random
 
 import numpy as np
 
-from .face_detection import detect_face
-from .utils import read_configs, read_hats
+from .face_detection import detect_faces, warm_up_cascades
+from .utils import get_scaled_hats
 from .wear_hat import wear_hat
 
 
-def wear_hats(img: np.ndarray, labels: str = "") -> np.ndarray:
-    hats = read_hats()
+def warm_up() -> None:
+    """Load the hats and the face detection classifiers ahead of the first image."""
+    get_scaled_hats()
+    warm_up_cascades()
+
+
+def wear_hats(
+    img: np.ndarray,
+    labels: str = "",
+    boxes: np.ndarray | None = None,
+    preset: str = "balanced",
+    timings: dict[str, float] | None = None,
+) -> np.ndarray:
+    """
+    Put hats on the faces in `img`. If the (N, 4) xyxy `boxes` of the detected objects
+    are given, only look for faces inside them. `preset` is one of the `PRESETS` of
+    face detection, from "quality" (native resolution) to "fast". `timings` receives
+    the time of each cascade as in `detect_faces`.
+    """
+    hats = get_scaled_hats()
 
     if "anime" in labels:
         modes = ["anime"]
@@ -18,9 +36,8 @@ def wear_hats(img: np.ndarray, labels: str = "") -> np.ndarray:
     if "cat" in labels:
         modes.append("cat")
 
-    for config in read_configs(modes):
-        for face in detect_face(img, config):
-            hat = random.choice(hats)
-            img = wear_hat(img, face, hat)
+    for face in detect_faces(img, modes, boxes, preset, timings=timings):
+        hat = hats.get(random.randrange(len(hats)), 2 * face[3])
+        img = wear_hat(img, face, hat, binary_alpha=True)
 
     return img
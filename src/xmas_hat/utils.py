@@ -1,3 +1,7 @@
+import functools as ft
+import math
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 import cv2
@@ -21,14 +25,75 @@ def read_configs(mode: list[str] = []) -> list[Path]:
     return list(map(lambda x: CFG_DIR / MODE_TO_PATH[x], mode))
 
 
-def read_hats() -> list[np.ndarray]:
+@ft.cache
+def read_hats() -> tuple[np.ndarray, ...]:
+    """Read the hats once. The arrays are shared by all callers and thus read-only."""
     res = []
-    for hat_path in HAT_DIR.iterdir():
+    for hat_path in sorted(HAT_DIR.iterdir()):
         img = cv2.cvtColor(cv2.imread(hat_path, -1), cv2.COLOR_BGRA2RGBA)
         img[..., :3] = np.where(
             np.logical_and(img[..., -1:] > 200, img[..., :3] == 0), 1, img[..., :3]
         )
         img[..., 3] = np.where(img[..., 3] > 127, 255, 0)
+        img.setflags(write=False)
         res.append(img)
 
-    return res
+    return tuple(res)
+
+
+class ScaledHats:
+    """
+    Hats resized to face-height buckets, kept in an LRU bounded by `max_bytes`.
+
+    Heights are bucketed geometrically by `bucket_ratio`, so faces of similar sizes
+    share one resized hat, whose size is off by at most `sqrt(bucket_ratio) - 1`. Like
+    `read_hats`, the alpha of the resized hats is either 0 or 255.
+    """
+
+    def __init__(
+        self,
+        hats: tuple[np.ndarray, ...],
+        max_bytes: int = 64 * 1024 * 1024,
+        bucket_ratio: float = 1.05,
+    ) -> None:
+        self.hats = hats
+        self.max_bytes = max_bytes
+        self.bucket_ratio = bucket_ratio
+
+        self._cache: OrderedDict[tuple[int, int], np.ndarray] = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.hats)
+
+    def get(self, index: int, height: float) -> np.ndarray:
+        """Hat `index` resized to about `height` pixels tall, keeping aspect ratio."""
+        bucket = round(math.log(max(height, 1), self.bucket_ratio))
+        key = (index, bucket)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        hat = self.hats[index]
+        scale = self.bucket_ratio**bucket / hat.shape[0]
+        scaled = cv2.resize(hat, (0, 0), fx=scale, fy=scale)
+        # interpolation blurs the thresholded alpha, so threshold it again
+        scaled[..., 3] = np.where(scaled[..., 3] > 127, 255, 0)
+        scaled.setflags(write=False)
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = scaled
+                self._num_bytes += scaled.nbytes
+            while self._num_bytes > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._num_bytes -= evicted.nbytes
+
+        return scaled
+
+
+@ft.cache
+def get_scaled_hats() -> ScaledHats:
+    return ScaledHats(read_hats())
@@ -2,9 +2,14 @@ import cv2
 import numpy as np
 
 
-def wear_hat(img: np.ndarray, face: np.ndarray, hat: np.ndarray) -> np.ndarray:
-    scale = face[3] / hat.shape[0] * 2
-    hat = cv2.resize(hat, (0, 0), fx=scale, fy=scale)
+def wear_hat(
+    img: np.ndarray, face: np.ndarray, hat: np.ndarray, binary_alpha: bool = False
+) -> np.ndarray:
+    """
+    Put `hat`, already scaled to about twice the height of `face`, on the face.
+
+    Set `binary_alpha` if the alpha of `hat` is either 0 or 255, as for `ScaledHats`.
+    """
     x_offset = int(face[0] + face[2] / 2 - hat.shape[1] / 2)
     y_offset = int(face[1] - hat.shape[0] / 2)
     x1 = max(x_offset, 0)
@@ -16,13 +21,27 @@ def wear_hat(img: np.ndarray, face: np.ndarray, hat: np.ndarray) -> np.ndarray:
     hat_y1 = max(0, -y_offset)
     hat_y2 = hat_y1 + y2 - y1
 
-    alpha_h = hat[hat_y1:hat_y2, hat_x1:hat_x2, 3] / 255
-    alpha = 1 - alpha_h
-
-    for channel in range(3):
-        img[y1:y2, x1:x2, channel] = (
-            alpha_h * hat[hat_y1:hat_y2, hat_x1:hat_x2, channel]
-            + alpha * img[y1:y2, x1:x2, channel]
-        )
+    composite(img[y1:y2, x1:x2], hat[hat_y1:hat_y2, hat_x1:hat_x2], binary_alpha)
 
     return img
+
+
+def composite(roi: np.ndarray, hat: np.ndarray, binary_alpha: bool = False) -> None:
+    """
+    Alpha-blend the RGBA `hat` onto the RGB `roi` in place.
+
+    If the alpha of `hat` only takes 0 and 255, blending is just a masked copy.
+    Otherwise both terms are scaled by OpenCV in 8 bits and summed straight into
+    `roi`, off by at most one from the exact blend.
+    """
+    if roi.size == 0:
+        return
+
+    if binary_alpha:
+        cv2.copyTo(hat[..., :3], hat[..., 3], roi)
+        return
+
+    alpha = cv2.cvtColor(hat[..., 3], cv2.COLOR_GRAY2RGB)
+    fg = cv2.multiply(hat[..., :3], alpha, scale=1 / 255)
+    bg = cv2.multiply(roi, 255 - alpha, scale=1 / 255)
+    cv2.add(fg, bg, dst=roi)
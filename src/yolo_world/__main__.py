@@ -1,4 +1,117 @@
+import argparse
+from pathlib import Path
+
+from .batch import iter_images, iter_manifest
+from .init import PRECISIONS, TIERS, export_artifact, init_runner
 from .server import Server
 
-server = Server()
-server.run()
+model_parser = argparse.ArgumentParser(add_help=False)
+model_parser.add_argument(
+    "--artifact", type=Path, help="load the model exported by `export` instead"
+)
+model_parser.add_argument(
+    "--precision",
+    choices=PRECISIONS,
+    default="fp32",
+    help="bf16 autocast, fast on hardware with native bf16 support",
+)
+model_parser.add_argument(
+    "--tiers",
+    nargs="+",
+    choices=TIERS,
+    help="model sizes to load (default: xl, or the one of --artifact); requests with "
+    "a latency budget may use smaller ones",
+)
+
+metrics_parser = argparse.ArgumentParser(add_help=False)
+metrics_parser.add_argument(
+    "--metrics-port",
+    type=int,
+    help="serve per-stage latencies in the Prometheus text format on this port",
+)
+metrics_parser.add_argument(
+    "--metrics-file", type=Path, help="dump per-stage latencies to this JSON file"
+)
+metrics_parser.add_argument(
+    "--metrics-interval",
+    type=float,
+    default=10.0,
+    help="seconds between two dumps of --metrics-file",
+)
+
+parser = argparse.ArgumentParser(prog="python -m src.yolo_world")
+subparsers = parser.add_subparsers(dest="command")
+serve_parser = subparsers.add_parser(
+    "serve", parents=[model_parser, metrics_parser], help="run the server (default)"
+)
+serve_parser.add_argument(
+    "--inference-procs",
+    type=int,
+    default=1,
+    help="run the model in this many processes, each pinned to its share of cores",
+)
+
+batch_parser = subparsers.add_parser(
+    "batch", parents=[model_parser, metrics_parser], help="process images offline"
+)
+batch_parser.add_argument(
+    "input", help="a directory, a glob pattern or a JSONL manifest of messages"
+)
+batch_parser.add_argument(
+    "--labels", help="comma-separated labels (required unless input is a manifest)"
+)
+batch_parser.add_argument(
+    "--output-dir", type=Path, help="where results go (default: next to inputs)"
+)
+batch_parser.add_argument("--batch-size", type=int, default=8)
+batch_parser.add_argument("--num-workers", type=int, default=4)
+batch_parser.add_argument("--prefetch", type=int, default=32)
+
+export_parser = subparsers.add_parser(
+    "export", help="save the model as one file for a fast start"
+)
+export_parser.add_argument("output", type=Path)
+export_parser.add_argument("--tier", choices=TIERS, default="xl")
+
+args = parser.parse_args()
+artifact = getattr(args, "artifact", None)
+precision = getattr(args, "precision", "fp32")
+tiers = getattr(args, "tiers", None)
+metrics_port = getattr(args, "metrics_port", None)
+metrics_file = getattr(args, "metrics_file", None)
+metrics_interval = getattr(args, "metrics_interval", 10.0)
+
+if args.command == "export":
+    export_artifact(init_runner(warm_up_batch_sizes=(), tier=args.tier), args.output)
+elif args.command == "batch":
+    if args.input.endswith(".jsonl"):
+        msgs = iter_manifest(Path(args.input))
+    else:
+        labels = [label.strip() for label in (args.labels or "").split(",")]
+        labels = [label for label in labels if label]
+        if not labels:
+            batch_parser.error("--labels is required unless the input is a manifest")
+        msgs = iter_images(args.input, labels, args.output_dir)
+
+    server = Server(
+        max_batch_size=args.batch_size,
+        artifact=artifact,
+        precision=precision,
+        tiers=tiers,
+        metrics_port=metrics_port,
+        metrics_file=metrics_file,
+        metrics_interval=metrics_interval,
+    )
+    server.run_batch(msgs, num_workers=args.num_workers, prefetch=args.prefetch)
+    server.close()
+else:
+    server = Server(
+        artifact=artifact,
+        precision=precision,
+        tiers=tiers,
+        num_inference_procs=getattr(args, "inference_procs", 1),
+        metrics_port=metrics_port,
+        metrics_file=metrics_file,
+        metrics_interval=metrics_interval,
+    )
+    server.run()
@@ -0,0 +1,73 @@
+import glob
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+from src.communication.messages import YoloMessage
+
+IMG_SUFFIXES = {".png", ".jpg", ".jpeg", ".bmp", ".webp"}
+
+
+@dataclass
+class InvalidLine:
+    """A line of a manifest that is not a valid message, in place of the message."""
+
+    manifest: Path
+    line_no: int
+    error: Exception
+
+
+def iter_manifest(manifest: Path) -> Iterator[YoloMessage | InvalidLine]:
+    """
+    Read one `YoloMessage`-shaped JSON object per line, skipping blank lines. A line
+    that cannot be parsed yields an `InvalidLine` so that the rest still runs.
+    """
+    with open(manifest, "r") as fd:
+        for line_no, line in enumerate(fd, 1):
+            if not line.strip():
+                continue
+            item: YoloMessage | InvalidLine
+            try:
+                item = YoloMessage.from_dict(json.loads(line))
+            except (ValueError, AssertionError) as e:
+                item = InvalidLine(manifest, line_no, e)
+            yield item
+
+
+def iter_images(
+    pattern: str, labels: list[str], output_dir: Path | None = None
+) -> Iterator[YoloMessage]:
+    """
+    Yield a message for every image matched by `pattern`.
+
+    `pattern` is either a directory, whose images are taken, or a (recursive) glob
+    pattern. Results are written to `output_dir` under the same path relative to the
+    directory or the non-wildcard part of the pattern if given, or next to the inputs.
+    """
+    if Path(pattern).is_dir():
+        pattern = f"{Path(pattern) / '*'}"
+    root = glob_root(pattern)
+
+    for img_path in sorted(map(Path, glob.iglob(pattern, recursive=True))):
+        if img_path.suffix.lower() not in IMG_SUFFIXES:
+            continue
+        # skip our own outputs when they live next to the inputs
+        if ".res" in img_path.suffixes:
+            continue
+
+        tgt_path = None
+        if output_dir is not None:
+            # inputs of the same name in different subdirectories must not collide
+            tgt_path = output_dir.resolve() / img_path.relative_to(root)
+            tgt_path.parent.mkdir(parents=True, exist_ok=True)
+        yield YoloMessage(img_path.resolve(), labels, tgt_path)
+
+
+def glob_root(pattern: str) -> Path:
+    """The leading directories of `pattern` that contain no wildcard."""
+    parts = Path(pattern).parts
+    for i, part in enumerate(parts):
+        if glob.has_magic(part):
+            return Path(*parts[:i])
+    return Path(pattern).parent
@@ -0,0 +1,32 @@
+# YOLO-World-L: same as `hf_app.py` (XL) but with the width and depth of YOLOv8-L
+_base_ = "hf_app.py"
+
+deepen_factor = 1.0
+widen_factor = 1.0
+last_stage_out_channels = 512
+neck_embed_channels = [128, 256, last_stage_out_channels // 2]
+neck_num_heads = [4, 8, last_stage_out_channels // 2 // 32]
+
+model = dict(
+    backbone=dict(
+        image_model=dict(
+            deepen_factor=deepen_factor,
+            widen_factor=widen_factor,
+            last_stage_out_channels=last_stage_out_channels,
+        ),
+    ),
+    neck=dict(
+        deepen_factor=deepen_factor,
+        widen_factor=widen_factor,
+        in_channels=[256, 512, last_stage_out_channels],
+        out_channels=[256, 512, last_stage_out_channels],
+        embed_channels=neck_embed_channels,
+        num_heads=neck_num_heads,
+    ),
+    bbox_head=dict(
+        head_module=dict(
+            widen_factor=widen_factor,
+            in_channels=[256, 512, last_stage_out_channels],
+        ),
+    ),
+)
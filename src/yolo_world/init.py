@@ -1,24 +1,192 @@
+import copy
+import re
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Iterable
 
+import numpy as np
+import torch
+from mmcv.cnn import fuse_conv_bn
 from mmengine.config import Config
 from mmengine.dataset import Compose
-from mmengine.runner import Runner
+from mmengine.device import get_device
+from mmengine.model import revert_sync_batchnorm
+from mmengine.registry import MODELS, init_default_scope
+from mmengine.runner.amp import autocast
+from mmengine.runner.checkpoint import load_state_dict
+from mmengine.utils import import_modules_from_strings
+from torch import nn
+
+from src.utils.files import atomic_path
 
 YOLO_DIR = Path(__file__).parent.resolve()
 CONF_DIR = YOLO_DIR / "configs"
 CKPT_DIR = YOLO_DIR.parent.parent / "ckpts"
 HF_CKPT = "yolo_world_v2_xl_obj365v1_goldg_cc3mlite_pretrain.pth"
+# config and checkpoint of each model size, from the fastest to the most accurate
+TIERS = {
+    "s": ("hf_app_s.py", "yolo_world_v2_s_obj365v1_goldg_pretrain.pth"),
+    "m": ("hf_app_m.py", "yolo_world_v2_m_obj365v1_goldg_pretrain.pth"),
+    "l": ("hf_app_l.py", "yolo_world_v2_l_obj365v1_goldg_cc3mlite_pretrain.pth"),
+    "x": ("hf_app_x.py", "yolo_world_v2_x_obj365v1_goldg_cc3mlite_pretrain.pth"),
+    "xl": ("hf_app.py", HF_CKPT),
+}
+ARTIFACT_VERSION = 2
+PRECISIONS = ("fp32", "bf16")
+
+
+@dataclass
+class InferenceRunner:
+    """
+    The parts of an mmengine `Runner` that inference needs.
+
+    `tier` is a key of `TIERS`. `pipeline_cfg` and `default_scope` are what `pipeline`
+    is built from. `precision` is one of `PRECISIONS`. `timings` holds the seconds spent
+    in each startup step, in order.
+    """
+
+    tier: str
+    model: nn.Module
+    pipeline: Compose
+    pipeline_cfg: list[dict]
+    default_scope: str
+    device: str
+    precision: str = "fp32"
+    timings: dict[str, float] = field(default_factory=dict)
+
+    def autocast(self):
+        """Run in bf16 where autocast allows it for "bf16", and in fp32 otherwise."""
+        return autocast(
+            device_type=self.device,
+            dtype=torch.bfloat16,
+            enabled=self.precision == "bf16",
+        )
+
+
+def init_runner(
+    warm_up_batch_sizes: Iterable[int] = (1,),
+    artifact: Path | None = None,
+    precision: str = "fp32",
+    tier: str = "xl",
+) -> InferenceRunner:
+    """
+    Build the model and the test pipeline without the training machinery of `Runner`
+    (dataloaders, optimizer, hooks, work dir), then run a dummy batch of each size in
+    `warm_up_batch_sizes` so that the first request does not pay for lazy init.
+
+    `tier` selects the model size. If `artifact` is given, load everything from that
+    file written by `export_artifact` instead, including the tier.
+    """
+    if tier not in TIERS:
+        raise ValueError(f"Tier should be one of {tuple(TIERS)}, got {tier}.")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precision should be one of {PRECISIONS}, got {precision}.")
+    device = get_device()
+
+    timings: dict[str, float] = {}
+    start = time.perf_counter()
+
+    def lap(step: str) -> None:
+        nonlocal start
+        now = time.perf_counter()
+        timings[step] = now - start
+        start = now
+
+    if artifact is None:
+        config_file, ckpt_file = TIERS[tier]
+        config = Config.fromfile(CONF_DIR / config_file)
+        import_modules_from_strings(**config.custom_imports)
+        default_scope = config.get("default_scope", "mmyolo")
+        init_default_scope(default_scope)
+        lap("config")
 
+        model = revert_sync_batchnorm(MODELS.build(config.model))
+        lap("build")
 
-def init_runner() -> Runner:
-    config = Config.fromfile(CONF_DIR / "hf_app.py")
-    config.load_from = f"{CKPT_DIR/HF_CKPT}"
-    config.work_dir = "./wkdir"
+        load_checkpoint(model, CKPT_DIR / ckpt_file)
+        lap("checkpoint")
 
-    runner = Runner.from_cfg(config)
-    runner.call_hook("before_run")
-    runner.load_or_resume()
-    runner.pipeline = Compose(config.test_dataloader.dataset.pipeline)
-    runner.model.eval()
+        pipeline_cfg = copy.deepcopy(config.test_dataloader.dataset.pipeline)
+        # images are decoded once by the server and handed over as arrays
+        pipeline_cfg[0] = dict(type="mmdet.LoadImageFromNDArray")
+    else:
+        # unpickling imports the modules of the model classes by itself
+        bundle = torch.load(artifact, map_location="cpu", mmap=True, weights_only=False)
+        if bundle.get("version") != ARTIFACT_VERSION:
+            raise ValueError(f"Unsupported artifact version {bundle.get('version')}.")
+        tier = bundle["tier"]
+        model = bundle["model"]
+        pipeline_cfg = bundle["pipeline"]
+        default_scope = bundle["default_scope"]
+        init_default_scope(default_scope)
+        lap("artifact")
+
+    model.to(device).eval()
+
+    runner = InferenceRunner(
+        tier,
+        model,
+        Compose(pipeline_cfg),
+        pipeline_cfg,
+        default_scope,
+        device,
+        precision,
+        timings,
+    )
+    lap("pipeline")
+
+    for batch_size in warm_up_batch_sizes:
+        warm_up_model(runner, batch_size)
+    lap("warm-up")
 
     return runner
+
+
+def export_artifact(runner: InferenceRunner, path: Path) -> None:
+    """
+    Save the model with its batch norms folded into the convolutions, together with
+    the pipeline, into one file that `init_runner` loads without parsing the config,
+    fetching the CLIP model or reading the checkpoint.
+
+    `runner` is modified in place and should not be used afterwards.
+    """
+    model = fuse_conv_bn(runner.model.cpu().eval())
+    bundle = {
+        "version": ARTIFACT_VERSION,
+        "tier": runner.tier,
+        "model": model,
+        "pipeline": runner.pipeline_cfg,
+        "default_scope": runner.default_scope,
+    }
+
+    with atomic_path(path) as tmp_path:
+        torch.save(bundle, tmp_path)
+
+
+def load_checkpoint(model: nn.Module, path: Path) -> None:
+    """
+    Load the weights of `path` into `model`.
+
+    The file is memory-mapped, so tensors are paged in as they are copied instead of
+    being read into memory first.
+    """
+    checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    state_dict = checkpoint.get("state_dict", checkpoint)
+    # same as the default `revise_keys` of `Runner.load_checkpoint`
+    state_dict = {re.sub(r"^module\.", "", k): v for k, v in state_dict.items()}
+    load_state_dict(model, state_dict, strict=False)
+
+
+def warm_up_model(runner: InferenceRunner, batch_size: int = 1) -> None:
+    """Run a dummy batch through the model to trigger kernel selection and caches."""
+    img = np.zeros((640, 640, 3), dtype=np.uint8)
+    data_info = runner.pipeline({"img_id": 0, "img": img, "texts": [["object"]]})
+    data_batch = {
+        "inputs": [data_info["inputs"]] * batch_size,
+        "data_samples": [
+            copy.deepcopy(data_info["data_samples"]) for _ in range(batch_size)
+        ],
+    }
+    with runner.autocast(), torch.no_grad():
+        runner.model.test_step(data_batch)
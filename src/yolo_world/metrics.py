@@ -0,0 +1,182 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Mapping
+
+import numpy as np
+
+from src.utils.files import atomic_path
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class _Latency:
+    """Durations of one stage: all-time count and sum, quantiles of the recent ones."""
+
+    def __init__(self, window: int) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.recent: deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self) -> dict[float, float]:
+        values = np.quantile(np.fromiter(self.recent, float), QUANTILES)
+        return dict(zip(QUANTILES, values.tolist()))
+
+
+class Metrics:
+    """
+    Thread-safe latencies of named stages, in seconds, counters of named events and
+    gauges read on demand.
+
+    Quantiles are computed over the last `window` durations of each stage, so that they
+    follow the current load rather than the whole uptime.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.window = window
+
+        self._latencies: dict[str, _Latency] = {}
+        self._counters: dict[str, int] = {}
+        self._gauges: dict[str, Callable[[], Mapping[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            latency = self._latencies.get(stage)
+            if latency is None:
+                latency = self._latencies[stage] = _Latency(self.window)
+            latency.observe(seconds)
+
+    def observe_all(self, timings: dict[str, float]) -> None:
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        """Observe the time spent in the `with` block under `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def increment(self, counter: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def register_gauges(
+        self, name: str, read: Callable[[], Mapping[str, float]]
+    ) -> None:
+        """Report the per-stage values returned by `read` under `name` in snapshots."""
+        with self._lock:
+            self._gauges[name] = read
+
+    def snapshot(self) -> dict:
+        """
+        Counters, gauges and, for every stage, count, sum and quantiles of its latency.
+        """
+        with self._lock:
+            latencies = {
+                stage: {
+                    "count": latency.count,
+                    "sum": latency.sum,
+                    **{f"p{round(q * 100)}": v for q, v in latency.quantiles().items()},
+                }
+                for stage, latency in sorted(self._latencies.items())
+            }
+            counters = dict(sorted(self._counters.items()))
+            gauges = dict(sorted(self._gauges.items()))
+        return {
+            "time": time.time(),
+            "counters": counters,
+            "gauges": {name: read() for name, read in gauges.items()},
+            "latencies": latencies,
+        }
+
+    def to_prometheus(self, prefix: str = "yolo_world") -> str:
+        """The snapshot in the Prometheus text format, latencies as summaries."""
+        snapshot = self.snapshot()
+        lines = []
+        for counter, value in snapshot["counters"].items():
+            name = f"{prefix}_{counter}_total"
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+
+        for gauge, values in snapshot["gauges"].items():
+            name = f"{prefix}_{gauge}"
+            lines.append(f"# TYPE {name} gauge")
+            for stage, value in values.items():
+                lines.append(f'{name}{{stage="{stage}"}} {value}')
+
+        name = f"{prefix}_stage_seconds"
+        lines.append(f"# TYPE {name} summary")
+        for stage, latency in snapshot["latencies"].items():
+            for q in QUANTILES:
+                value = latency[f"p{round(q * 100)}"]
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {value}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {latency["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {latency["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: Path) -> None:
+        """Write the snapshot to `path` as JSON, replacing the previous one at once."""
+        with atomic_path(path) as tmp_path:
+            tmp_path.write_text(json.dumps(self.snapshot(), indent=2))
+
+
+def serve_metrics(
+    metrics: Metrics, port: int, host: str = "127.0.0.1"
+) -> ThreadingHTTPServer:
+    """Serve `metrics` at http://`host`:`port`/metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", f"{len(body)}")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            # scrapes would flood stderr otherwise
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def dump_metrics(metrics: Metrics, path: Path, interval: float) -> Callable[[], None]:
+    """
+    Dump `metrics` to `path` every `interval` seconds from a daemon thread. The returned
+    function stops the thread, waiting for a dump in progress, then dumps a last time.
+    """
+    stopped = threading.Event()
+
+    def loop() -> None:
+        while not stopped.wait(interval):
+            metrics.dump(path)
+
+    thread = threading.Thread(target=loop, name="metrics-dump", daemon=True)
+    thread.start()
+
+    def stop() -> None:
+        stopped.set()
+        thread.join()
+        metrics.dump(path)
+
+    return stop
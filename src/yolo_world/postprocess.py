@@ -0,0 +1,46 @@
+import numpy as np
+import torch
+from mmengine.structures import InstanceData
+from torchvision.ops import batched_nms
+
+
+def filter_boxes(
+    batch: list[InstanceData],
+    score_thres: float,
+    nms_thres: float,
+    max_num_boxes: int,
+) -> list[np.ndarray]:
+    """
+    Keep the boxes of each image scoring above `score_thres` that survive NMS among
+    boxes of the same image and class, at most `max_num_boxes` per image, best first.
+
+    The whole batch goes through one NMS call, and only the kept boxes are copied off
+    the device, into a single array whose slices are returned.
+    """
+    # NumPy has no bf16
+    bboxes = torch.cat([results.bboxes for results in batch]).float()
+    scores = torch.cat([results.scores for results in batch]).float()
+    labels = torch.cat([results.labels for results in batch])
+    sizes = torch.tensor([len(results) for results in batch], device=bboxes.device)
+    images = torch.arange(len(batch), device=bboxes.device).repeat_interleave(sizes)
+
+    # a box can only be suppressed by a higher-scoring one, so thresholding first
+    # keeps the same boxes while NMS sees far fewer
+    candidates = (scores > score_thres).nonzero().squeeze(1)
+    num_classes = int(labels.max()) + 1 if len(labels) > 0 else 1
+    groups = images[candidates] * num_classes + labels[candidates]
+    keep = candidates[
+        batched_nms(bboxes[candidates], scores[candidates], groups, nms_thres)
+    ]
+
+    # `keep` is sorted by score, and a stable sort by image keeps that within images
+    kept_images, order = torch.sort(images[keep], stable=True)
+    keep = keep[order]
+    counts = torch.bincount(kept_images, minlength=len(batch))
+    starts = counts.cumsum(0) - counts
+    ranks = torch.arange(len(keep), device=keep.device) - starts[kept_images]
+    keep = keep[ranks < max_num_boxes]
+
+    boxes = bboxes[keep].cpu().numpy()
+    counts = counts.clamp(max=max_num_boxes).cumsum(0)[:-1].cpu().numpy()
+    return np.split(boxes, counts)
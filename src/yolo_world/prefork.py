@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+
+import torch
+
+NODE_DIR = Path("/sys/devices/system/node")
+
+
+def parse_cpulist(cpulist: str) -> list[int]:
+    """Parse a kernel CPU list such as "0-3,8,10-11"."""
+    cores = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cores += range(int(first), int(last or first) + 1)
+    return cores
+
+
+def split_cores(num_sets: int) -> list[list[int]]:
+    """
+    Split the cores this process may run on into `num_sets` contiguous sets of about
+    the same size. Cores are ordered by NUMA node first, so that each set spans as few
+    nodes as possible.
+    """
+    usable = os.sched_getaffinity(0)
+    if num_sets > len(usable):
+        raise ValueError(f"Cannot split {len(usable)} cores into {num_sets} sets.")
+
+    cores: list[int] = []
+    nodes = sorted(NODE_DIR.glob("node[0-9]*"), key=lambda p: int(p.name[4:]))
+    for node in nodes:
+        for core in parse_cpulist((node / "cpulist").read_text()):
+            if core in usable and core not in cores:
+                cores.append(core)
+    cores += sorted(usable - set(cores))
+
+    size, extra = divmod(len(cores), num_sets)
+    sets, start = [], 0
+    for i in range(num_sets):
+        end = start + size + (i < extra)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+def pin_to_cores(cores: list[int]) -> None:
+    """
+    Run this process on `cores` only, with one intra-op thread per core and a single
+    inter-op thread, as the forward pass has no independent ops to run concurrently.
+    """
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
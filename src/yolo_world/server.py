@@ -1,104 +1,929 @@
-import json
 import logging
+import queue
+import signal
+import socket
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from multiprocessing import connection
+from multiprocessing.process import BaseProcess
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 from tempfile import gettempdir
+from typing import Iterable
 
 import numpy as np
 import torch
-from mmengine.runner import Runner
-from mmengine.runner.amp import autocast
-from PIL import Image
-from torchvision.ops import nms
+import torch.multiprocessing as mp
+from mmengine.device import get_device
 
-from src.communication.messages import YoloMessage
-from src.xmas_hat.process import wear_hats
-from src.yolo_world.init import init_runner
-from src.yolo_world.utils import combine_masks, mask_from_box_coordinates
+from src.communication.messages import (
+    CancelMessage,
+    OutputOptions,
+    SharedImage,
+    YoloMessage,
+    YoloResponse,
+)
+from src.communication.shm import attach_image
+from src.communication.transport import create_server, recv_msg, send_msg
+from src.xmas_hat.process import warm_up, wear_hats
+from src.yolo_world.batch import InvalidLine
+from src.yolo_world.init import TIERS, InferenceRunner, init_runner, warm_up_model
+from src.yolo_world.metrics import Metrics, dump_metrics, serve_metrics
+from src.yolo_world.postprocess import filter_boxes
+from src.yolo_world.prefork import pin_to_cores, split_cores
+from src.yolo_world.text_cache import TextEmbeddingCache, predict_with_text_feats
+from src.yolo_world.utils import (
+    FORMAT_TO_SUFFIX,
+    SUFFIX_TO_FORMAT,
+    apply_mask,
+    load_image,
+    mask_from_boxes,
+    resize_to_fit,
+    save_image,
+)
+
+# labels of the blank image timed to estimate the latency of a model
+PROBE_LABELS = ("object",)
+
+
+@dataclass
+class _Client:
+    """A connected front end. Responses to its requests are routed back via `conn`."""
+
+    conn: socket.socket
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def reply(self, response: YoloResponse) -> bool:
+        try:
+            with self.lock:
+                send_msg(self.conn, response.to_dict())
+            return True
+        except OSError:
+            return False
+
+
+@dataclass
+class _Job:
+    """A request travelling through the decode, inference and postprocess stages."""
+
+    request_id: str
+    msg: YoloMessage
+    client: _Client
+    labels: tuple[str, ...] = ()
+    img: np.ndarray | None = None
+    data_info: dict | None = None
+    tier: str = ""
+    boxes: np.ndarray | None = None
+    segment: SharedMemory | None = None
+    cancelled: bool = False
+    accepted: float = field(default_factory=time.perf_counter)
+
+
+@dataclass(eq=False)
+class _Worker:
+    """An inference process, the front end of its pipe and the batch it is running."""
+
+    process: BaseProcess
+    conn: connection.Connection
+    task: tuple[str, list[_Job]] | None = None
 
 
 class Server:
-    runner: Runner
+    runners: dict[str, InferenceRunner]
+    runner: InferenceRunner
     nms_thres: float
     score_thres: float
     max_num_boxes: int
-    msg_file: Path
+    max_queue_size: int
+    retry_after: float
+    max_batch_size: int
+    max_wait: float
+    probe_interval: float
+    num_decode_workers: int
+    num_postprocess_workers: int
+    face_preset: str
+    metrics: Metrics
+    metrics_port: int | None
+    metrics_file: Path | None
+    metrics_interval: float
+    sock_file: Path
 
     def __init__(
         self,
         nms_thres: float = 0.5,
         score_thres: float = 0.05,
         max_num_boxes: int = 100,
+        max_queue_size: int = 32,
+        retry_after: float = 1.0,
+        max_batch_size: int = 4,
+        max_wait: float = 0.02,
+        text_cache_size: int = 64,
+        num_decode_workers: int = 2,
+        num_postprocess_workers: int = 2,
+        stage_queue_size: int = 8,
+        face_preset: str = "balanced",
+        num_encode_workers: int = 2,
+        warm_up_batch_sizes: Iterable[int] | None = None,
+        artifact: Path | None = None,
+        precision: str = "fp32",
+        tiers: Iterable[str] | None = None,
+        num_inference_procs: int = 1,
+        metrics_port: int | None = None,
+        metrics_file: Path | None = None,
+        metrics_interval: float = 10.0,
+        probe_interval: float = 30.0,
     ) -> None:
         self._log_path: Path
         self._logger: logging.Logger
         self._setup_logger()
 
-        self.runner = init_runner()
-        self._logger.info("Runner initialized.")
+        if warm_up_batch_sizes is None:
+            warm_up_batch_sizes = sorted({1, max_batch_size})
+        warm_up_batch_sizes = list(warm_up_batch_sizes)
+        self._warm_up_batch_sizes = warm_up_batch_sizes
+        if num_inference_procs > 1 and get_device() != "cpu":
+            # CUDA cannot be re-initialized in a forked child
+            raise ValueError("Multiple inference processes only run on the CPU.")
+        if num_inference_procs > 1:
+            # a child forked after the OpenMP pool has started hangs on its first
+            # parallel op, so the front end stays single-threaded and the workers warm
+            # up after forking
+            torch.set_num_threads(1)
+            warm_up_batch_sizes = []
+        if artifact is not None and tiers is not None:
+            raise ValueError("An artifact holds its own tier, do not pass tiers too.")
+        if tiers is None:
+            # with an artifact, the tier it was exported from replaces this one
+            tiers = ["xl"]
+        unknown = set(tiers) - set(TIERS)
+        if unknown:
+            raise ValueError(f"Unknown tiers {unknown}, expect some of {tuple(TIERS)}.")
+        # from the fastest to the most accurate, like `TIERS`
+        tiers = sorted(set(tiers), key=list(TIERS).index)
+        self.runners = {}
+        # seconds per image of each tier, when it last ran, and the tiers whose next
+        # measurement replaces an estimate gone stale
+        self._latency: dict[str, float] = {}
+        self._last_run: dict[str, float] = {}
+        self._stale: set[str] = set()
+        for tier in tiers:
+            runner = init_runner(warm_up_batch_sizes, artifact, precision, tier)
+            timings = runner.timings
+            self._logger.info(
+                f"Runner {runner.tier} initialized in {sum(timings.values()):.2f}s ("
+                + ", ".join(f"{step} {t:.2f}s" for step, t in timings.items())
+                + ")."
+            )
+            self.runners[runner.tier] = runner
+        # the most accurate model serves requests without a latency budget
+        self.runner = list(self.runners.values())[-1]
 
         self.nms_thres = nms_thres
         self.score_thres = score_thres
         self.max_num_boxes = max_num_boxes
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.probe_interval = probe_interval
+        self.num_decode_workers = num_decode_workers
+        self.num_postprocess_workers = num_postprocess_workers
+        self.face_preset = face_preset
+
+        # per-stage latencies, exported while serving if a port or file is given
+        self.metrics = Metrics()
+        self.metrics.register_gauges("queue_depth", self.queue_depths)
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+
+        self._text_caches = {
+            tier: TextEmbeddingCache(runner.model, text_cache_size)
+            for tier, runner in self.runners.items()
+        }
+
+        # received -> decode -> decoded -> inference -> inferred -> postprocess
+        self._jobs: queue.Queue[_Job] = queue.Queue(maxsize=max_queue_size)
+        self._decoded: queue.Queue[_Job] = queue.Queue(maxsize=stage_queue_size)
+        self._inferred: queue.Queue[_Job] = queue.Queue(maxsize=stage_queue_size)
+        # requests that have been accepted but not answered, for cancellation
+        self._active: dict[str, _Job] = {}
+        self._active_lock = threading.Lock()
+
+        # secondary artifacts are encoded after the response has been sent
+        self._encoders = ThreadPoolExecutor(
+            num_encode_workers, thread_name_prefix="encode"
+        )
+        self._background: set[Future] = set()
+        self._background_lock = threading.Lock()
+
+        # forward passes run in worker processes if `num_inference_procs` > 1
+        self._workers: list[_Worker] = []
+        self._idle: queue.Queue[_Worker] = queue.Queue()
+        self._workers_lock = threading.Lock()
+        if num_inference_procs > 1:
+            self._start_workers(num_inference_procs)
+        else:
+            self._log_latencies(self._measure_latencies())
 
-        self.msg_file = Path(gettempdir()) / "yolo-world-server.msg"
-        if not self.msg_file.exists():
-            self.msg_file.touch()
-        self._logger.info(f"Use {self.msg_file} to communicate.")
+        # the face detection pool starts threads, so only after forking
+        warm_up()
+        self._logger.info("Hats and face detectors loaded.")
 
-        self._timestamp: int
-        self._update_timestamp()
-        self._logger.info(f"Current timestamp: {self._timestamp}")
+        self.sock_file = Path(gettempdir()) / "yolo-world-server.sock"
 
     def run(self) -> None:
+        listener = create_server(self.sock_file)
+        self._logger.info(f"Use {self.sock_file} to communicate.")
+
+        for i in range(self.num_decode_workers):
+            threading.Thread(
+                target=self._decode_loop, name=f"decode-{i}", daemon=True
+            ).start()
+        threading.Thread(
+            target=self._inference_loop, name="inference", daemon=True
+        ).start()
+        if self._workers:
+            threading.Thread(
+                target=self._result_loop, name="inference-results", daemon=True
+            ).start()
+        for i in range(self.num_postprocess_workers):
+            threading.Thread(
+                target=self._postprocess_loop, name=f"postprocess-{i}", daemon=True
+            ).start()
+
         try:
+            with self._exporting_metrics():
+                while True:
+                    conn, _ = listener.accept()
+                    threading.Thread(
+                        target=self._serve, args=(_Client(conn),), daemon=True
+                    ).start()
+
+        except KeyboardInterrupt:
+            self._logger.warning("Abort due to keyboard interrupt.")  # TODO: use logger
+        finally:
+            listener.close()
+            self.sock_file.unlink(missing_ok=True)
+            self.close()
+
+    def close(self) -> None:
+        """Stop the encoder threads and the inference processes."""
+        self._encoders.shutdown()
+        for worker in self._workers:
+            worker.process.terminate()
+            worker.process.join()
+
+    def run_batch(
+        self,
+        msgs: Iterable[YoloMessage | InvalidLine],
+        num_workers: int = 4,
+        prefetch: int = 32,
+    ) -> None:
+        """
+        Process `msgs` offline without the socket. Invalid manifest lines are logged
+        and counted as failed.
+
+        Images are decoded and preprocessed ahead of the model by `num_workers` loader
+        threads (at most `prefetch` in flight), consecutive messages with the same
+        labels are batched into one forward pass, and results are written by
+        `num_workers` writer threads.
+        """
+        num_done = num_failed = 0
+        start = time.perf_counter()
+
+        msg_iter = iter(msgs)
+        loading: deque[tuple[YoloMessage, tuple[str, tuple[str, ...]], Future]]
+        loading = deque()
+        writing: deque[tuple[YoloMessage, Future]] = deque()
+
+        with self._exporting_metrics():
+            with ThreadPoolExecutor(num_workers) as loaders, ThreadPoolExecutor(
+                num_workers
+            ) as writers:
+
+                def prefetch_more() -> None:
+                    nonlocal num_failed
+                    while len(loading) < prefetch:
+                        msg = next(msg_iter, None)
+                        if msg is None:
+                            return
+                        if isinstance(msg, InvalidLine):
+                            self._logger.error(
+                                f"Skip line {msg.line_no} of {msg.manifest}.",
+                                exc_info=msg.error,
+                            )
+                            num_failed += 1
+                            continue
+                        labels = TextEmbeddingCache.normalize(msg.labels)
+                        tier = self._route(msg.latency_budget, self.max_batch_size)
+                        key = (tier, labels)
+                        future = loaders.submit(self._decode, msg.img_path, labels)
+                        loading.append((msg, key, future))
+
+                def wait_for_writes(max_pending: int) -> None:
+                    nonlocal num_done, num_failed
+                    while len(writing) > max_pending:
+                        msg, future = writing.popleft()
+                        try:
+                            future.result()
+                            num_done += 1
+                        except Exception:
+                            self._logger.exception(f"Failed to process {msg.img_path}.")
+                            num_failed += 1
+
+                prefetch_more()
+                while len(loading) > 0:
+                    batch = [loading.popleft()]
+                    while (
+                        len(loading) > 0
+                        and len(batch) < self.max_batch_size
+                        and loading[0][1] == batch[0][1]
+                    ):
+                        batch.append(loading.popleft())
+                    prefetch_more()
+
+                    msgs_ok, imgs, data_infos = [], [], []
+                    for msg, _, future in batch:
+                        try:
+                            img, data_info = future.result()
+                            msgs_ok.append(msg)
+                            imgs.append(img)
+                            data_infos.append(data_info)
+                        except Exception:
+                            self._logger.exception(f"Failed to load {msg.img_path}.")
+                            num_failed += 1
+                    if len(msgs_ok) == 0:
+                        continue
+
+                    try:
+                        tier, labels = batch[0][1]
+                        timings: dict[str, float] = {}
+                        batch_boxes = self._inference(data_infos, labels, tier, timings)
+                        self.metrics.observe_all(timings)
+                    except Exception:
+                        self._logger.exception("Failed to run inference.")
+                        num_failed += len(msgs_ok)
+                        continue
+
+                    for msg, img, boxes in zip(msgs_ok, imgs, batch_boxes):
+                        future = writers.submit(self._process, msg, img, boxes)
+                        writing.append((msg, future))
+                    wait_for_writes(prefetch)
+
+                wait_for_writes(0)
+            self._wait_for_background()
+
+        elapsed = time.perf_counter() - start
+        self._logger.info(
+            f"Processed {num_done} images in {elapsed:.2f}s "
+            f"({num_done / max(elapsed, 1e-9):.2f} images/s), {num_failed} failed."
+        )
+
+    def _serve(self, client: _Client) -> None:
+        """Read requests of one client and put them into the job queue."""
+        self._logger.debug("Client connected.")
+        with client.conn:
             while True:
-                msg = self._wait_for_msg()
-                if msg.tgt_path is None:
-                    save_path = msg.img_path.with_suffix(f".res{msg.img_path.suffix}")
-                else:
-                    save_path = msg.tgt_path
+                timings: dict[str, float] = {}
+                try:
+                    obj = recv_msg(client.conn, timings)
+                except (ConnectionError, ValueError) as e:
+                    self._logger.warning(f"Drop connection: {e}")
+                    break
+                if obj is None:
+                    break
+                self.metrics.observe_all(timings)
+
+                try:
+                    if CancelMessage.is_cancel(obj):
+                        self._cancel(CancelMessage.from_dict(obj).request_id, client)
+                        continue
+                    msg = YoloMessage.from_dict(obj)
+                except AssertionError:
+                    client.reply(YoloResponse("error", error="Malformed request."))
+                    continue
+
+                request_id = msg.request_id or uuid.uuid4().hex
+                job = _Job(request_id, msg, client)
+                with self._active_lock:
+                    self._active[request_id] = job
+                try:
+                    self._jobs.put_nowait(job)
+                except queue.Full:
+                    with self._active_lock:
+                        self._active.pop(request_id, None)
+                    self._logger.warning(f"Queue is full. Reject request {request_id}.")
+                    self.metrics.increment("responses_busy")
+                    client.reply(
+                        YoloResponse(
+                            "busy",
+                            error="Request queue is full.",
+                            request_id=request_id,
+                            retry_after=self.retry_after,
+                        )
+                    )
+                    continue
+                self._logger.debug(
+                    f"Enqueued request {request_id} ({self._jobs.qsize()} pending)."
+                )
+        self._logger.debug("Client disconnected.")
+
+    def _cancel(self, request_id: str, client: _Client) -> None:
+        """Flag the request, which is dropped when it reaches the next stage."""
+        with self._active_lock:
+            job = self._active.get(request_id)
+            if job is None or job.client is not client:
+                self._logger.debug(f"Nothing to cancel for request {request_id}.")
+                return
+            job.cancelled = True
+        self._logger.info(f"Request {request_id} cancelled.")
+
+    def _skip_cancelled(self, job: _Job, stage: str) -> bool:
+        """
+        Answer "cancelled" and return `True` if `job` was cancelled, otherwise report
+        that it enters `stage`.
+        """
+        if job.cancelled:
+            self._reply(job, YoloResponse("cancelled"))
+            return True
+
+        if job.msg.progress:
+            job.client.reply(
+                YoloResponse("progress", request_id=job.request_id, stage=stage)
+            )
+        return False
+
+    def queue_depths(self) -> dict[str, int]:
+        """Number of requests waiting in front of each stage."""
+        return {
+            "decode": self._jobs.qsize(),
+            "inference": self._decoded.qsize(),
+            "postprocess": self._inferred.qsize(),
+        }
+
+    def _decode_loop(self) -> None:
+        while True:
+            job = self._jobs.get()
+            if self._skip_cancelled(job, "decode"):
+                continue
+            job.labels = TextEmbeddingCache.normalize(job.msg.labels)
+            try:
+                with self.metrics.time("decode"):
+                    job.img, job.segment = self._load(job.msg)
+                with self.metrics.time("preprocess"):
+                    job.data_info = self._preprocess(job.img, job.labels)
+            except Exception as e:
+                self._logger.exception(f"Failed to load {job.msg.img_path}.")
+                self._reply(job, YoloResponse("error", error=f"{e}"))
+                continue
+            self._decoded.put(job)
+
+    def _inference_loop(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            if not batch:
+                # idle, so the probes delay no request
+                self._probe_stale_tiers()
+                continue
+            jobs = [job for job in batch if not self._skip_cancelled(job, "inference")]
+            if not jobs:
+                continue
+            self._logger.debug(f"Queue depths: {self.queue_depths()}.")
+
+            # requests can only share a forward pass if they share the model and the
+            # vocabulary
+            same_labels: dict[tuple[str, ...], list[_Job]] = {}
+            for job in jobs:
+                same_labels.setdefault(job.labels, []).append(job)
+            groups: dict[tuple[str, tuple[str, ...]], list[_Job]] = {}
+            for labels, labels_jobs in same_labels.items():
+                self._assign_tiers(labels_jobs)
+                for job in labels_jobs:
+                    groups.setdefault((job.tier, labels), []).append(job)
 
+            for (tier, labels), group in groups.items():
                 self._logger.info(
-                    f"Start inference on {msg.img_path} "
-                    f"with labels {','.join(msg.labels)}."
+                    f"Start inference on {len(group)} images with model {tier} "
+                    f"and labels {','.join(labels)}."
                 )
-                boxes = self._inference(msg.img_path, msg.labels)
-                self._logger.info(f"Detected {len(boxes)} objects.")
-
-                # create mask and save masked image
-                original_img = Image.open(msg.img_path)
-                masks = [mask_from_box_coordinates(box, original_img) for box in boxes]
-                if len(masks) == 0:
-                    masks.append(np.ones_like(original_img))
-                mask = combine_masks(masks)
-                masked_img = original_img * mask
-                self._logger.info("Masks successfully applied.")
-                with open(save_path.with_stem("masked"), "wb") as fd:
-                    Image.fromarray(masked_img).save(fd)
-
-                # call xmas hat
-                masked_img = wear_hats(masked_img, ",".join(msg.labels))
-                self._logger.info("Christmas hats successfully added.")
-                with open(save_path.with_stem("masked-with-hats"), "wb") as fd:
-                    Image.fromarray(masked_img).save(fd)
-
-                # overlay hatted image to original one
-                overlayed_img = np.where(masked_img > 0, masked_img, original_img)
-                self._logger.info("Original image successfully overlayed.")
-
-                # save processed image
-                res_img = Image.fromarray(overlayed_img)
-                with open(save_path, "wb") as fd:
-                    res_img.save(fd)
-                self._logger.info(f"Saved to {save_path}.")
+                # boxes are matched to the jobs by position, so none may be dropped
+                data_infos = []
+                for job in group:
+                    assert job.data_info is not None
+                    data_infos.append(job.data_info)
+                if self._workers:
+                    self._dispatch(group, data_infos, labels, tier)
+                    continue
 
-        except KeyboardInterrupt:
-            self._logger.warning("Abort due to keyboard interrupt.")  # TODO: use logger
+                timings: dict[str, float] = {}
+                try:
+                    batch_boxes = self._inference(data_infos, labels, tier, timings)
+                except Exception as e:
+                    self._logger.exception("Failed to run inference.")
+                    for job in group:
+                        self._reply(job, YoloResponse("error", error=f"{e}"))
+                    continue
+                self.metrics.observe_all(timings)
+                self._forward(group, batch_boxes)
+
+    def _forward(self, group: list[_Job], batch_boxes: list[np.ndarray]) -> None:
+        for job, boxes in zip(group, batch_boxes):
+            job.data_info = None
+            job.boxes = boxes
+            self._inferred.put(job)
+
+    def _start_workers(self, num_procs: int) -> None:
+        """
+        Fork `num_procs` inference processes, each pinned to its own set of cores. The
+        children share the weights of the parent copy-on-write.
+        """
+        ctx = mp.get_context("fork")
+        for i, cores in enumerate(split_cores(num_procs)):
+            # tensors sent through the pipes are moved to shared memory, not pickled
+            conn, child_conn = ctx.Pipe()
+            # the child must not keep the front-end ends of any pipe open, or it would
+            # never see EOF once the front end is gone
+            inherited = [worker.conn for worker in self._workers] + [conn]
+            process = ctx.Process(
+                target=self._worker_loop,
+                args=(cores, child_conn, inherited),
+                name=f"inference-{i}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            worker = _Worker(process, conn)
+            self._workers.append(worker)
+            self._idle.put(worker)
+            self._logger.info(f"Inference worker {process.pid} runs on cores {cores}.")
+
+        # every worker reports its latencies once warmed up
+        measured = [worker.conn.recv() for worker in self._workers]
+        now = time.monotonic()
+        for tier in self.runners:
+            self._latency[tier] = float(np.mean([m[tier] for m in measured]))
+            self._last_run[tier] = now
+        self._log_latencies(self._latency)
+
+    def _worker_loop(
+        self,
+        cores: list[int],
+        conn: connection.Connection,
+        inherited: list[connection.Connection],
+    ) -> None:
+        """Run forward passes dispatched by the front end, in a worker process."""
+        for front_end_conn in inherited:
+            front_end_conn.close()
+        # the front end handles Ctrl-C and terminates the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pin_to_cores(cores)
+        for runner in self.runners.values():
+            for batch_size in self._warm_up_batch_sizes:
+                warm_up_model(runner, batch_size)
+        conn.send(self._measure_latencies())
+
+        while True:
+            try:
+                tier, labels, data_infos = conn.recv()
+            except EOFError:
+                # the front end has exited
+                return
+            # metrics of this process are not exported, so hand timings back
+            timings: dict[str, float] = {}
+            try:
+                batch_boxes = self._inference(data_infos, labels, tier, timings)
+            except Exception as e:
+                self._logger.exception("Failed to run inference.")
+                conn.send((None, timings, f"{e}"))
+                continue
+            conn.send((batch_boxes, timings, None))
+
+    def _dispatch(
+        self,
+        group: list[_Job],
+        data_infos: list[dict],
+        labels: tuple[str, ...],
+        tier: str,
+    ) -> None:
+        """Hand a forward pass to whichever worker process is idle first."""
+        while True:
+            try:
+                worker = self._idle.get(timeout=1.0)
+            except queue.Empty:
+                worker = None
+            with self._workers_lock:
+                if worker in self._workers:
+                    worker.task = (tier, group)
+                    break
+                if not self._workers:
+                    worker = None
+                    break
+
+        if worker is None:
+            for job in group:
+                self._reply(
+                    job, YoloResponse("error", error="No inference worker is running.")
+                )
+            return
+        try:
+            worker.conn.send((tier, labels, data_infos))
+        except OSError:
+            # the worker has died, `_result_loop` fails its task
+            pass
+
+    def _result_loop(self) -> None:
+        while True:
+            with self._workers_lock:
+                workers = list(self._workers)
+            if not workers:
+                self._logger.error("All inference workers have died.")
+                return
+
+            conns = {worker.conn: worker for worker in workers}
+            sentinels = {worker.process.sentinel: worker for worker in workers}
+            ready = connection.wait([*conns, *sentinels])
+            # take the last results of a worker before noticing that it died
+            for obj in ready:
+                if obj in conns:
+                    self._receive(conns[obj])
+            for obj in ready:
+                if obj in sentinels:
+                    self._on_worker_died(sentinels[obj])
+
+    def _receive(self, worker: _Worker) -> None:
+        try:
+            batch_boxes, timings, error = worker.conn.recv()
+        except (EOFError, OSError):
+            self._on_worker_died(worker)
+            return
+        with self._workers_lock:
+            task, worker.task = worker.task, None
+        self._idle.put(worker)
+        assert task is not None
+        tier, group = task
+
+        if error is not None:
+            for job in group:
+                self._reply(job, YoloResponse("error", error=error))
+            return
+        self._record_latency(tier, timings["test_step"], len(batch_boxes))
+        self.metrics.observe_all(timings)
+        self._forward(group, batch_boxes)
+
+    def _on_worker_died(self, worker: _Worker) -> None:
+        """Fail the batch of a dead worker and stop dispatching to it."""
+        with self._workers_lock:
+            if worker not in self._workers:
+                return
+            self._workers.remove(worker)
+            task, worker.task = worker.task, None
+        worker.process.join()
+        worker.conn.close()
+        self._logger.error(
+            f"Inference worker {worker.process.pid} died with exit code "
+            f"{worker.process.exitcode}."
+        )
+
+        if task is not None:
+            for job in task[1]:
+                self._reply(job, YoloResponse("error", error="Inference worker died."))
+
+    def _postprocess_loop(self) -> None:
+        while True:
+            job = self._inferred.get()
+            if self._skip_cancelled(job, "postprocess"):
+                continue
+            assert job.img is not None and job.boxes is not None
+            try:
+                save_path = self._process(job.msg, job.img, job.boxes)
+                response = YoloResponse("ok", save_path, res_shm=job.msg.res_shm)
+            except Exception as e:
+                self._logger.exception(f"Failed to process request {job.request_id}.")
+                response = YoloResponse("error", error=f"{e}")
+            self._reply(job, response)
+
+    def _collect_batch(self) -> list[_Job]:
+        """
+        Wait for one job, then up to `max_wait` seconds for more to join it. Return none
+        if no job comes within `probe_interval` seconds.
+        """
+        try:
+            jobs = [self._decoded.get(timeout=self.probe_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(jobs) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(self._decoded.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return jobs
+
+    def _reply(self, job: _Job, response: YoloResponse) -> None:
+        self._release(job)
+        self.metrics.increment(f"responses_{response.status}")
+        if response.status == "ok":
+            self.metrics.observe("total", time.perf_counter() - job.accepted)
+        with self._active_lock:
+            if self._active.get(job.request_id) is job:
+                del self._active[job.request_id]
+        response.request_id = job.request_id
+        if not job.client.reply(response):
+            self._logger.warning(
+                f"Client of request {job.request_id} has disconnected."
+            )
+
+    def _process(
+        self, msg: YoloMessage, original_img: np.ndarray, boxes: np.ndarray
+    ) -> Path | None:
+        """
+        Create the requested artifacts and return the path of the primary one, which is
+        "result" if requested. The others may still be being encoded.
+
+        If `msg.res_shm` is set, the result is written into it instead, every file is
+        written in the background and `None` is returned.
+        """
+        output = msg.output
+        save_path = self._save_path(msg)
+        write_result = "result" in output.artifacts and msg.res_shm is None
+        if msg.res_shm is not None:
+            primary = None
+        elif write_result:
+            primary = "result"
+        else:
+            primary = output.artifacts[0]
+        futures: dict[str, Future] = {}
+
+        self._logger.info(f"Detected {len(boxes)} objects in {msg.img_path}.")
+
+        # create mask and save masked image
+        with self.metrics.time("mask"):
+            if len(boxes) == 0:
+                masked_img = original_img.copy()
+            else:
+                masked_img = apply_mask(
+                    original_img, mask_from_boxes(boxes, original_img.shape)
+                )
+        self._logger.info("Masks successfully applied.")
+        if "masked" in output.artifacts:
+            # hats are drawn in place, so encode a snapshot
+            futures["masked"] = self._encode(
+                masked_img.copy(), save_path, "masked", output
+            )
+
+        # call xmas hat
+        # no boxes means the whole image is kept, so search all of it
+        timings: dict[str, float] = {}
+        with self.metrics.time("wear_hats"):
+            masked_img = wear_hats(
+                masked_img,
+                ",".join(msg.labels),
+                boxes if len(boxes) > 0 else None,
+                self.face_preset,
+                timings,
+            )
+        self.metrics.observe_all(timings)
+        self._logger.info("Christmas hats successfully added.")
+        if "masked-with-hats" in output.artifacts:
+            futures["masked-with-hats"] = self._encode(
+                masked_img, save_path, "masked-with-hats", output
+            )
+
+        if write_result or "preview" in output.artifacts:
+            # overlay hatted image to original one
+            overlayed_img = np.where(masked_img > 0, masked_img, original_img)
+            self._logger.info("Original image successfully overlayed.")
+            if write_result:
+                futures["result"] = self._encode(
+                    overlayed_img, save_path, "result", output
+                )
+            if "preview" in output.artifacts:
+                preview = resize_to_fit(overlayed_img, output.preview_size)
+                futures["preview"] = self._encode(preview, save_path, "preview", output)
+
+        for artifact, future in futures.items():
+            if artifact != primary:
+                with self._background_lock:
+                    self._background.add(future)
+                future.add_done_callback(self._on_background_done)
+
+        if msg.res_shm is not None:
+            with self.metrics.time("write-shared"):
+                self._write_shared(msg.res_shm, masked_img, original_img)
+            self._logger.info(f"Wrote result to segment {msg.res_shm.name}.")
+            return None
+
+        assert primary is not None
+        futures[primary].result()
+        primary_path = self._artifact_path(save_path, primary)
+        self._logger.info(f"Saved to {primary_path}.")
+
+        return primary_path
+
+    @staticmethod
+    def _write_shared(
+        ref: SharedImage, masked_img: np.ndarray, original_img: np.ndarray
+    ) -> None:
+        """Overlay the hatted image to the original one right into the segment."""
+        if ref.shape != original_img.shape:
+            raise ValueError(f"Expect a segment of shape {original_img.shape}.")
+
+        segment, res_img = attach_image(ref, writable=True)
+        try:
+            np.copyto(res_img, original_img)
+            np.copyto(res_img, masked_img, where=masked_img > 0)
+        finally:
+            del res_img
+            segment.close()
+
+    def _save_path(self, msg: YoloMessage) -> Path:
+        if msg.tgt_path is None:
+            save_path = msg.img_path.with_suffix(f".res{msg.img_path.suffix}")
+        else:
+            save_path = msg.tgt_path
+
+        fmt = msg.output.format
+        if fmt is not None and SUFFIX_TO_FORMAT.get(save_path.suffix.lower()) != fmt:
+            save_path = save_path.with_suffix(FORMAT_TO_SUFFIX[fmt])
+        return save_path
+
+    @staticmethod
+    def _artifact_path(save_path: Path, artifact: str) -> Path:
+        if artifact == "result":
+            return save_path
+        return save_path.with_stem(f"{save_path.stem}.{artifact}")
+
+    def _encode(
+        self, img: np.ndarray, save_path: Path, artifact: str, output: OutputOptions
+    ) -> Future:
+        return self._encoders.submit(
+            self._save,
+            img,
+            self._artifact_path(save_path, artifact),
+            artifact,
+            output,
+        )
+
+    def _save(
+        self, img: np.ndarray, path: Path, artifact: str, output: OutputOptions
+    ) -> None:
+        with self.metrics.time(f"encode-{artifact}"):
+            save_image(img, path, output.format, output.quality)
+
+    @contextmanager
+    def _exporting_metrics(self):
+        """Export `metrics` to the configured port and file while in the block."""
+        http_server = stop_dump = None
+        if self.metrics_port is not None:
+            http_server = serve_metrics(self.metrics, self.metrics_port)
+            self._logger.info(
+                f"Serve metrics at http://127.0.0.1:{self.metrics_port}/metrics."
+            )
+        if self.metrics_file is not None:
+            stop_dump = dump_metrics(
+                self.metrics, self.metrics_file, self.metrics_interval
+            )
+            self._logger.info(f"Dump metrics to {self.metrics_file}.")
+
+        try:
+            yield
+        finally:
+            if http_server is not None:
+                http_server.shutdown()
+                http_server.server_close()
+            if stop_dump is not None:
+                stop_dump()
+
+    def _on_background_done(self, future: Future) -> None:
+        with self._background_lock:
+            self._background.discard(future)
+        if future.exception() is not None:
+            self._logger.error(f"Failed to save an artifact: {future.exception()}")
+
+    def _wait_for_background(self) -> None:
+        with self._background_lock:
+            pending = list(self._background)
+        wait(pending)
 
     def _setup_logger(self) -> None:
         log_path = Path(gettempdir()) / "yolo-world-server.log"
         logger = logging.getLogger("yolo-world")
+        self._log_path = log_path
+        self._logger = logger
+        # the logger is global, so a second server in the process must not log twice
+        if logger.handlers:
+            return
+
         logger.setLevel(logging.DEBUG)
         formatter = logging.Formatter(
             "[%(asctime)s][%(name)s][%(levelname)s] - %(message)s"
@@ -114,54 +939,184 @@ class Server:
         stream_handler.setFormatter(formatter)
         logger.addHandler(stream_handler)
 
-        self._log_path = log_path
-        self._logger = logger
+    def _load(self, msg: YoloMessage) -> tuple[np.ndarray, SharedMemory | None]:
+        if msg.img_shm is None:
+            return load_image(msg.img_path), None
 
-    def _update_timestamp(self) -> None:
-        self._timestamp = self.msg_file.stat().st_mtime_ns
-        self._logger.debug(f"Update timestamp to be {self._timestamp}.")
+        # a read-only view of the pixels the client placed in the segment
+        segment, img = attach_image(msg.img_shm)
+        return img, segment
 
-    def _wait_for_msg(self) -> YoloMessage:
-        cnt = 0
-        while True:
-            if self.msg_file.stat().st_mtime_ns > self._timestamp:
-                break
+    def _release(self, job: _Job) -> None:
+        """Drop the images of a finished job and unmap its segment."""
+        job.img = job.data_info = None
+        if job.segment is not None:
+            try:
+                job.segment.close()
+            except BufferError:
+                # still referenced somewhere, the mapping goes when that is collected
+                self._logger.warning(f"Segment {job.segment.name} is still in use.")
+            job.segment = None
+
+    def detect(
+        self, img_path: Path, labels: Iterable[str], tier: str | None = None
+    ) -> np.ndarray:
+        """Boxes of objects of `labels` in the image at `img_path`, one per row."""
+        key = TextEmbeddingCache.normalize(labels)
+        _, data_info = self._decode(img_path, key)
+        return self._inference([data_info], key, tier or self.runner.tier)[0]
+
+    def _route(self, latency_budget: float | None, batch_size: int = 1) -> str:
+        """
+        The most accurate model expected to run a batch of `batch_size` images within
+        `latency_budget` seconds, or the fastest one if none is.
+        """
+        if latency_budget is None:
+            return self.runner.tier
+        for tier in reversed(self.runners):
+            if self._latency[tier] * batch_size <= latency_budget:
+                return tier
+        return next(iter(self.runners))
+
+    def _assign_tiers(self, jobs: list[_Job]) -> None:
+        """
+        Route each job of `jobs`, which share their labels, to the most accurate model
+        expected to run the group of jobs it joins within its latency budget, or to the
+        fastest one if none is.
+        """
+        sizes = dict.fromkeys(self.runners, 0)
+        budgeted = []
+        for job in jobs:
+            if job.msg.latency_budget is None:
+                job.tier = self.runner.tier
+                sizes[job.tier] += 1
             else:
-                time.sleep(0.1)
-                cnt += 1
-                if cnt >= 100:
-                    self._logger.debug("No request for 10 seconds.")
-                    cnt = 0
+                budgeted.append((job.msg.latency_budget, job))
+        # a group finishes at once, so the job that joins it last must have the
+        # tightest budget of the group
+        budgeted.sort(key=lambda item: item[0], reverse=True)
+        for latency_budget, job in budgeted:
+            job.tier = next(
+                (
+                    tier
+                    for tier in reversed(self.runners)
+                    if self._latency[tier] * (sizes[tier] + 1) <= latency_budget
+                ),
+                next(iter(self.runners)),
+            )
+            sizes[job.tier] += 1
 
-        self._update_timestamp()
-        with open(self.msg_file, "r") as fd:
-            return YoloMessage.from_dict(json.load(fd))
+    def _measure_latencies(self) -> dict[str, float]:
+        """
+        Time a forward pass of one blank image on every tier, with its labels already
+        in the text embedding cache, and return the seconds per image.
+        """
+        for tier, runner in self.runners.items():
+            with runner.autocast(), torch.no_grad():
+                self._text_caches[tier].get(PROBE_LABELS)
+            self._inference([self._probe_data_info()], PROBE_LABELS, tier)
+        return dict(self._latency)
 
-    def _inference(self, img_path: Path, labels: list[str]) -> np.ndarray:
-        texts = [[label] for label in labels]
-        data_info = self.runner.pipeline(
-            {"img_id": 0, "img_path": img_path, "texts": texts}
+    def _log_latencies(self, latencies: dict[str, float]) -> None:
+        self._logger.info(
+            "Inference latency per image: "
+            + ", ".join(f"{tier} {t * 1e3:.1f}ms" for tier, t in latencies.items())
+            + "."
         )
+
+    def _probe_stale_tiers(self) -> None:
+        """
+        Time a blank image on every tier that has not run for `probe_interval` seconds,
+        so that the estimate of a tier that routing avoids is renewed. Only called while
+        no request is waiting.
+        """
+        if len(self.runners) < 2:
+            return
+        now = time.monotonic()
+        for tier in self.runners:
+            if now - self._last_run[tier] < self.probe_interval:
+                continue
+            # not again before the result, which may come from a worker process
+            self._last_run[tier] = now
+            self._stale.add(tier)
+            self._logger.debug(f"Probe the latency of model {tier}.")
+            data_infos = [self._probe_data_info()]
+            if self._workers:
+                self._dispatch([], data_infos, PROBE_LABELS, tier)
+                continue
+            try:
+                self._inference(data_infos, PROBE_LABELS, tier)
+            except Exception:
+                self._logger.exception(f"Failed to probe model {tier}.")
+
+    def _probe_data_info(self) -> dict:
+        return self._preprocess(np.zeros((640, 640, 3), dtype=np.uint8), PROBE_LABELS)
+
+    def _decode(
+        self, img_path: Path, labels: tuple[str, ...]
+    ) -> tuple[np.ndarray, dict]:
+        """Decode the image once and share the array with the model and later stages."""
+        with self.metrics.time("decode"):
+            img = load_image(img_path)
+        with self.metrics.time("preprocess"):
+            return img, self._preprocess(img, labels)
+
+    def _preprocess(self, img: np.ndarray, labels: tuple[str, ...]) -> dict:
+        texts = [[label] for label in labels]
+        data_info = self.runner.pipeline({"img_id": 0, "img": img, "texts": texts})
+        # the model expects BGR, and flipping the letterboxed tensor is cheaper
+        data_info["inputs"] = data_info["inputs"].flip(0)
+        return data_info
+
+    def _inference(
+        self,
+        data_infos: list[dict],
+        labels: tuple[str, ...],
+        tier: str,
+        timings: dict[str, float] | None = None,
+    ) -> list[np.ndarray]:
+        """
+        Boxes of each image of the batch. If `timings` is given, the seconds spent in
+        the forward pass and in filtering are stored under "test_step" and "nms".
+        """
+        # the data preprocessor stacks (and pads if needed) the list into one batch
         data_batch = {
-            "inputs": data_info["inputs"][None],
-            "data_samples": [data_info["data_samples"]],
+            "inputs": [data_info["inputs"] for data_info in data_infos],
+            "data_samples": [data_info["data_samples"] for data_info in data_infos],
         }
 
-        with autocast(enabled=False), torch.no_grad():
-            output = self.runner.model.test_step(data_batch)[0]
-
-        results = output.pred_instances
-        keep = nms(results.bboxes, results.scores, iou_threshold=self.nms_thres)
-        results = results[keep]
-        results = results[results.scores.float() > self.score_thres]
+        runner = self.runners[tier]
+        text_cache = self._text_caches[tier]
+        with runner.autocast(), torch.no_grad():
+            # a miss encodes the labels, which is no part of the latency of the tier
+            txt_feats = text_cache.get(labels)
+            start = time.perf_counter()
+            outputs = predict_with_text_feats(runner.model, data_batch, txt_feats)
+        elapsed = time.perf_counter() - start
+        self._record_latency(tier, elapsed, len(data_infos))
+        self._logger.debug(
+            f"Text embedding cache of {tier}: {text_cache.hits} hits, "
+            f"{text_cache.misses} misses."
+        )
 
-        if len(results.scores) > self.max_num_boxes:
-            self._logger.info(
-                f"Detect more objects than {self.max_num_boxes}. "
-                f"Pick top {self.max_num_boxes}."
-            )
-            indices = results.scores.float().topk(self.max_num_boxes)[1]
-            results = results[indices]
+        start = time.perf_counter()
+        batch_boxes = filter_boxes(
+            [output.pred_instances for output in outputs],
+            self.score_thres,
+            self.nms_thres,
+            self.max_num_boxes,
+        )
+        if timings is not None:
+            timings["test_step"] = elapsed
+            timings["nms"] = time.perf_counter() - start
+        return batch_boxes
 
-        results = results.cpu().numpy()
-        return results.bboxes
+    def _record_latency(self, tier: str, elapsed: float, batch_size: int) -> None:
+        per_image = elapsed / batch_size
+        if tier not in self._latency or tier in self._stale:
+            self._latency[tier] = per_image
+            self._stale.discard(tier)
+        else:
+            # exponential moving average, so routing follows the load of the machine
+            self._latency[tier] += 0.2 * (per_image - self._latency[tier])
+        self._last_run[tier] = time.monotonic()
@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable
+
+import torch
+from torch import nn
+
+
+class TextEmbeddingCache:
+    """
+    LRU cache of CLIP text embeddings keyed by the normalized label tuple.
+
+    The text backbone is frozen, so the embedding of a vocabulary never changes and can
+    be reused by every request with the same labels.
+    """
+
+    def __init__(self, model: nn.Module, max_size: int = 64) -> None:
+        self._model = model
+        self._max_size = max_size
+        self._cache: OrderedDict[tuple[str, ...], torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(labels: Iterable[str]) -> tuple[str, ...]:
+        """The CLIP tokenizer is case-insensitive, so neither is the key."""
+        return tuple(label.strip().lower() for label in labels)
+
+    def get(self, labels: Iterable[str]) -> torch.Tensor:
+        """Return the embeddings of `labels`, shaped (1, num_labels, text_channels)."""
+        key = self.normalize(labels)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self.misses += 1
+
+        with torch.no_grad():
+            txt_feats = self._model.backbone.forward_text([list(key)])
+
+        with self._lock:
+            self._cache[key] = txt_feats
+            if len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+        return txt_feats
+
+
+def predict_with_text_feats(
+    model: nn.Module, data_batch: dict, txt_feats: torch.Tensor
+) -> list:
+    """
+    Same as `model.test_step(data_batch)` but reuse `txt_feats` instead of running the
+    text backbone, mirroring `YOLOWorldDetector.predict`.
+    """
+    data = model.data_preprocessor(data_batch, False)
+    inputs, data_samples = data["inputs"], data["data_samples"]
+    txt_feats = txt_feats.repeat(inputs.shape[0], 1, 1)
+
+    img_feats = model.backbone.forward_image(inputs)
+    if model.with_neck:
+        if model.mm_neck:
+            img_feats = model.neck(img_feats, txt_feats)
+        else:
+            img_feats = model.neck(img_feats)
+
+    model.bbox_head.num_classes = txt_feats[0].shape[0]
+    results_list = model.bbox_head.predict(
+        img_feats, txt_feats, data_samples, rescale=True
+    )
+    return model.add_pred_to_datasample(data_samples, results_list)
@@ -1,21 +1,78 @@
-import functools as ft
+from pathlib import Path
 
+import cv2
 import numpy as np
+from PIL import Image, ImageOps
 
+from src.utils.files import atomic_path
 
-def mask_from_box_coordinates(coordinates: np.ndarray, img: np.ndarray) -> np.ndarray:
-    assert coordinates.shape == (4,)
+SUFFIX_TO_FORMAT = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png", ".webp": "webp"}
+FORMAT_TO_SUFFIX = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+DEFAULT_QUALITY = 90
+# zlib level 1 encodes ~2.5x faster than PIL's default 6 for ~7% larger photos
+PNG_COMPRESS_LEVEL = 1
 
-    ul_br_coords = np.round(coordinates).astype(np.int32)
-    ul, br = np.split(ul_br_coords, 2)
-    width = br[0] - ul[0]
-    height = br[1] - ul[1]
-    mask = np.zeros_like(img)
-    mask[ul[1] :, ul[0] :][:height, :width] = 1
+
+def load_image(img_path: Path) -> np.ndarray:
+    """Decode an image as an RGB array, applying EXIF orientation like OpenCV does."""
+    with Image.open(img_path) as img:
+        return np.asarray(ImageOps.exif_transpose(img).convert("RGB"))
+
+
+def mask_from_boxes(boxes: np.ndarray, shape: tuple[int, ...]) -> np.ndarray:
+    """
+    Single-channel boolean mask of `shape[:2]` that is True inside any of the (N, 4)
+    xyxy `boxes`.
+
+    All boxes are filled into one buffer. Filling a boolean slice is a memset, which
+    stays cheaper than integrating a 2D difference array even when boxes overlap a lot.
+    """
+    assert boxes.ndim == 2 and boxes.shape[1] == 4
+    height, width = shape[:2]
+
+    coords = np.round(boxes).astype(np.int64)
+    x1, x2 = np.clip(coords[:, 0::2], 0, width).T
+    y1, y2 = np.clip(coords[:, 1::2], 0, height).T
+
+    mask = np.zeros((height, width), dtype=bool)
+    for left, top, right, bottom in zip(x1, y1, x2, y2):
+        mask[top:bottom, left:right] = True
 
     return mask
 
 
-def combine_masks(masks: list[np.ndarray]) -> np.ndarray:
-    assert len(masks) > 0
-    return ft.reduce(np.logical_or, masks, np.zeros_like(masks[0]))
+def apply_mask(img: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Zero `img` outside `mask`, applying the single-channel mask to every channel."""
+    return cv2.bitwise_and(img, img, mask=mask.view(np.uint8))
+
+
+def resize_to_fit(img: np.ndarray, size: int) -> np.ndarray:
+    """Downscale `img` so that its longer side is at most `size` pixels."""
+    scale = size / max(img.shape[:2])
+    if scale >= 1:
+        return img
+    return cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def save_image(
+    img: np.ndarray, path: Path, fmt: str | None = None, quality: int | None = None
+) -> None:
+    """
+    Encode `img` as `fmt` (by default inferred from the suffix of `path`).
+
+    The image is written to a temporary file next to `path` and renamed into place.
+    """
+    suffix = path.suffix.lower()
+    fmt = fmt or SUFFIX_TO_FORMAT.get(suffix)
+    params: dict = {}
+    if fmt in ("jpeg", "webp"):
+        params["quality"] = quality or DEFAULT_QUALITY
+    elif fmt == "png":
+        params["compress_level"] = PNG_COMPRESS_LEVEL
+
+    pil_format = fmt.upper() if fmt else Image.registered_extensions().get(suffix)
+    if pil_format is None:
+        raise ValueError(f"Unknown image format of {path}.")
+
+    with atomic_path(path) as tmp_path:
+        Image.fromarray(img).save(tmp_path, format=pil_format, **params)